@@ -7,8 +7,41 @@
 import curses
 import curses.ascii
 import argparse
+import json
+import threading
+from itertools import chain
+from time import perf_counter
+from string import digits, ascii_lowercase
 
-from tfe_base import TFEBoard, ANSI_VALS, ilog
+from tfe_base import (TFEBoard, History, Profile, ANSI_VALS, COLOUR_INDEX,
+                      EXP_COLOUR_INDEX, DEFAULT_HISTORY_CELLS, render_cell)
+from tfe_bitboard import BitBoard
+from tfe_parallel import ParallelTFEBoard
+from tfe_ai import STRATEGIES, DEFAULT_DEPTH, make_player
+import tfe_save
+from tfe_replay import MoveLog
+
+# characters for the heatmap, indexed by the bit_length of the biggest tile in a
+# block, so they show its exponent
+HEAT_CHARS = " " + digits + ascii_lowercase
+HEAT_TABLE = [HEAT_CHARS[min(bits, len(HEAT_CHARS) - 1)]
+                for bits in range(len(COLOUR_INDEX))]
+
+# curses attributes for COLOUR_INDEX and EXP_COLOUR_INDEX, made on first use as
+# curses has to be set up first
+PAIRS = None
+EXP_PAIRS = None
+
+def get_pairs():
+    """
+    Get the curses attributes for tiles by bit_length and by exponent, making
+    them if necessary.
+    """
+    global PAIRS, EXP_PAIRS
+    if PAIRS is None:
+        PAIRS = [curses.color_pair(i) for i in COLOUR_INDEX]
+        EXP_PAIRS = [curses.color_pair(i) for i in EXP_COLOUR_INDEX]
+    return PAIRS, EXP_PAIRS
 
 class DefaultSentinel:
     """
@@ -31,49 +64,403 @@ def get_args():
     parser.add_argument("--allow-arrows", action="store_true",
             help="Allow using the arrow keys. Not recommended for cool people")
     parser.add_argument("--auto", action="store_true",
-            help="Play automatically, by trying to go left, up, right, down")
+            help="Play automatically")
+    parser.add_argument("--auto-strategy", choices=STRATEGIES,
+            default="simple",
+            help="Strategy for --auto. The simple strategy goes left, up, "
+                 "right or down, in order of preference")
     parser.add_argument("--auto-chunk", type=int, default=chunk_sentinel,
-            help="Number of game steps to do in between refreshing the screen")
+            help="Number of game steps to do in between refreshing the screen "
+                 "(1 for expectimax)")
+    parser.add_argument("--auto-depth", type=int, default=DEFAULT_DEPTH,
+            help="Search depth for --auto-strategy=expectimax")
+    parser.add_argument("--auto-target-ms", type=float, default=None,
+            help="Adjust the number of game steps between refreshes to aim "
+                 "for frames of this many milliseconds")
+    parser.add_argument("--fps", type=float, default=None,
+            help="Play in a separate thread, redrawing at this many frames per "
+                 "second, rather than in chunks")
+    parser.add_argument("--bitboard", action="store_true",
+            help="Use the packed 4x4 board implementation")
+    parser.add_argument("--compact", action="store_true",
+            help="Store the board compactly, as tile exponents")
+    parser.add_argument("--parallel", type=int, metavar="PROCESSES",
+            help="Sift lines across this many worker processes (needs "
+                 "--compact). Only worth it for boards in the hundreds or "
+                 "more")
+    parser.add_argument("--history-cells", type=int,
+            default=DEFAULT_HISTORY_CELLS,
+            help="Number of cells to keep in the undo history")
+    parser.add_argument("--seed", type=int, default=None,
+            help="Seed for the random tiles")
+    parser.add_argument("--load", metavar="PATH",
+            help="Carry on with a saved game")
+    parser.add_argument("--save", metavar="PATH",
+            help="Save the game here when quitting")
+    parser.add_argument("--autosave", type=float, metavar="SECONDS",
+            help="Also save the game (and move log) this often")
+    parser.add_argument("--record", metavar="PATH",
+            help="Record a move log here, for tfe_replay.py")
+    parser.add_argument("--profile", action="store_true",
+            help="Count calls and time spent sifting, adding tiles and "
+                 "drawing. Press p to show the counts")
+    parser.add_argument("--profile-out", metavar="PATH",
+            help="Write the profile counts here as JSON when quitting "
+                 "(implies --profile)")
     parser.add_argument("n", type=int, nargs="?", default=4,
-            help="Board size")
+            help="Board size (ignored with --load)")
     args = parser.parse_args()
+    if args.autosave is not None and args.save is None and args.record is None:
+        parser.error("--autosave can only be used with --save or --record")
+    if args.load is not None and args.seed is not None:
+        parser.error("--seed can't be used with --load")
+    if args.bitboard and args.n != 4:
+        parser.error("--bitboard only supports a board size of 4")
     if args.auto_chunk is not chunk_sentinel and not args.auto:
         parser.error("--auto-chunk can only be used with --auto")
+    if args.fps is not None and not args.auto:
+        parser.error("--fps can only be used with --auto")
+    if args.fps is not None and args.auto_chunk is not chunk_sentinel:
+        parser.error("--fps can't be used with --auto-chunk")
+    if args.fps is not None and args.fps <= 0:
+        parser.error("--fps must be positive")
+    if args.auto_target_ms is not None and not args.auto:
+        parser.error("--auto-target-ms can only be used with --auto")
+    if args.auto_target_ms is not None and args.fps is not None:
+        parser.error("--auto-target-ms can't be used with --fps")
+    if args.auto_target_ms is not None and args.auto_target_ms <= 0:
+        parser.error("--auto-target-ms must be positive")
+    expectimax = args.auto and args.auto_strategy == "expectimax"
+    if args.bitboard and expectimax:
+        parser.error("--auto-strategy=expectimax can't be used with "
+                     "--bitboard")
+    if args.compact and expectimax:
+        parser.error("--auto-strategy=expectimax can't be used with "
+                     "--compact")
+    if args.compact and args.bitboard:
+        parser.error("--compact can't be used with --bitboard")
+    if args.parallel is not None and not args.compact:
+        parser.error("--parallel can only be used with --compact")
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.profile_out is not None:
+        args.profile = True
     if args.auto_chunk is chunk_sentinel:
-        args.auto_chunk = args.auto_chunk.val
+        # searching is slow enough to want to see every move, and the chunk is
+        # worked out as we go if there's a target.
+        if expectimax or args.auto_target_ms is not None:
+            args.auto_chunk = 1
+        else:
+            args.auto_chunk = args.auto_chunk.val
     return args
 
-def ncfmt(y, x, stdscr, board, cell_width=7):
+class BoardSnapshot:
     """
-    Printing a board with curses primitives
+    Copy of the parts of a board needed to draw it, as taken by an AutoThread.
     """
-    for i in range(board.n):
-        stdscr.addstr(y + 2 * i, x, ("-" * cell_width)
-                                        .join("+" * (board.n + 1)))
-        stdscr.addstr(y + 2 * i + 1, x, "|")
-        for j in range(board.n):
-            square = board.squares[i * board.n + j]
-            if square:
-                stdscr.addstr("{:{}}".format(square, cell_width),
-                              curses.color_pair(
-                                    min(ilog(square), len(ANSI_VALS))))
-                stdscr.addstr("|")
+    def __init__(self, n, compact=False):
+        self.n = n
+        self.compact = compact
+        self.score = 0
+        self.squares = [0] * n ** 2
+        # what the board's dirty_cells gave for each copy since the last call
+        # to dirty_cells, or None for every square
+        self.changed = None
+
+    def dirty_cells(self, full=False):
+        """
+        Get the indices of the squares that have changed since the last call,
+        as handed over by the board with each copy. If `full` is given, or on
+        the first call, that's all of them.
+        """
+        changed = self.changed
+        self.changed = []
+        if full or changed is None:
+            return range(len(self.squares))
+        return chain.from_iterable(changed)
+
+class AutoThread(threading.Thread):
+    """
+    Plays a game as fast as possible in its own thread, so that the screen can
+    be redrawn at a steady rate regardless of how long moves take. Snapshots
+    are taken by the playing thread in between moves when asked for, since
+    waiting on a lock it keeps taking back would starve the other thread.
+    """
+    def __init__(self, board, player, after_move=None):
+        super().__init__(daemon=True)
+        self.board = board
+        self.player = player
+        # called with the name of every move after it's made, from this thread
+        self.after_move = after_move
+        self.stopped = threading.Event()
+        self.requested = threading.Event()
+        self.ready = threading.Event()
+        self.snap = None
+
+    def run(self):
+        """
+        Make moves until the game is over, or until stopped.
+        """
+        while not self.stopped.is_set():
+            move = self.player.best_move()
+            if move is None:
+                break
+            getattr(self.board, move)()
+            if self.after_move is not None:
+                self.after_move(move)
+            if self.requested.is_set():
+                self.requested.clear()
+                self.copy()
+                self.ready.set()
+        self.stopped.set()
+
+    def copy(self):
+        """
+        Copy the current state of the board into the requested snapshot.
+        """
+        squares = self.board.squares
+        # a ParallelTFEBoard's squares are a view of shared memory, and a slice
+        # of that would just be another view
+        if isinstance(squares, memoryview):
+            self.snap.squares = bytearray(squares)
+        else:
+            self.snap.squares = squares[:]
+        self.snap.score = self.board.score
+        # taken even if it isn't needed, so the board doesn't pile up changes
+        changed = self.board.dirty_cells()
+        if self.snap.changed is not None:
+            self.snap.changed.append(changed)
+
+    def snapshot(self, snap):
+        """
+        Copy the current state of the board into a BoardSnapshot, at the end of
+        the current move.
+        """
+        self.snap = snap
+        self.ready.clear()
+        self.requested.set()
+        while not self.ready.wait(0.01):
+            if not self.is_alive():
+                break
+        if not self.ready.is_set():
+            # the game is over, so there's nobody to race with
+            self.copy()
+
+class Viewport:
+    """
+    The part of the board that's on screen: the cell in the top left corner,
+    and the size of the blocks of cells shown by each character in heatmap
+    mode, or 0 to show cells normally.
+    """
+    def __init__(self):
+        self.top = 0
+        self.left = 0
+        self.block = 0
+
+    def capacity(self, y, stdscr, cell_width=7):
+        """
+        Number of rows and columns of cells (or blocks) that fit on screen from
+        line y down, leaving the last column free so curses doesn't complain.
+        """
+        height, width = stdscr.getmaxyx()
+        if self.block:
+            return max(0, height - y), max(0, width - 1)
+        return (max(0, (height - y - 1) // 2),
+                max(0, (width - 2) // (cell_width + 1)))
+
+    def size(self, y, stdscr, n, cell_width=7):
+        """
+        Number of rows and columns of cells (or blocks) actually shown.
+        """
+        rows, cols = self.capacity(y, stdscr, cell_width)
+        step = self.block or 1
+        return (min(rows, -(-(n - self.top) // step)),
+                min(cols, -(-(n - self.left) // step)))
+
+    def pan(self, y, stdscr, n, dy, dx, page=False, cell_width=7):
+        """
+        Move by dy rows and dx columns of cells, or of blocks, or of whole
+        screens if `page` is given.
+        """
+        rows, cols = self.capacity(y, stdscr, cell_width)
+        if page:
+            dy *= rows
+            dx *= cols
+        step = self.block or 1
+        self.top = max(0, min(self.top + dy * step, n - rows * step))
+        self.left = max(0, min(self.left + dx * step, n - cols * step))
+
+    def zoom(self, y, stdscr, n):
+        """
+        Cycle between normal cells, and heatmaps of bigger and bigger blocks
+        until the whole board fits.
+        """
+        rows, cols = self.capacity(y, stdscr)
+        if not self.block:
+            self.block = 1
+        elif -(-n // self.block) <= min(rows, cols):
+            self.block = 0
+        else:
+            self.block *= 2
+        self.top = self.left = 0
+
+def ncgrid(y, x, stdscr, rows, cols, cell_width=7):
+    """
+    Draw the grid lines of a board, which don't change from frame to frame
+    """
+    sep = ("-" * cell_width).join("+" * (cols + 1))
+    row = (" " * cell_width).join("|" * (cols + 1))
+    for i in range(rows):
+        stdscr.addstr(y + 2 * i, x, sep)
+        stdscr.addstr(y + 2 * i + 1, x, row)
+    stdscr.addstr(y + 2 * rows, x, sep)
+
+def ncheat(y, x, stdscr, board, view):
+    """
+    Printing a zoomed out board, as one character per block of cells, showing
+    the biggest tile in that block.
+    """
+    n = board.n
+    block = view.block
+    squares = board.squares
+    pairs, _ = get_pairs()
+    rows, cols = view.size(y, stdscr, n)
+    for bi in range(rows):
+        top = view.top + bi * block
+        starts = range(top * n, min(top + block, n) * n, n)
+        for bj in range(cols):
+            left = view.left + bj * block
+            right = min(left + block, n)
+            big = max(max(squares[start + left:start + right])
+                        for start in starts)
+            if board.compact:
+                bits = big + 1 if big else 0
             else:
-                stdscr.addstr("{}|".format(" " * cell_width))
-    stdscr.addstr(y + 2 * board.n, x, ("-" * cell_width)
-                                        .join("+" * (board.n + 1)))
+                bits = big.bit_length()
+            stdscr.addstr(y + bi, x + bj, HEAT_TABLE[bits], pairs[bits])
+
+def ncfmt(y, x, stdscr, board, cell_width=7, full=False, view=None,
+          profile=None):
+    """
+    Printing a board with curses primitives. Only the cells that changed since
+    the last call are repainted, unless `full` is given, in which case the grid
+    is drawn as well. If a Viewport is given, only the part of the board in it
+    is drawn. If a Profile is given, the time taken is counted as "draw".
+    """
+    if profile is not None:
+        start = perf_counter()
+        ncfmt(y, x, stdscr, board, cell_width, full, view)
+        profile.add("draw", perf_counter() - start)
+        return
+    if view is None:
+        view = Viewport()
+    if view.block:
+        # dirty cells aren't much use when every character covers many cells,
+        # but they still need to be kept up to date.
+        board.dirty_cells(True)
+        ncheat(y, x, stdscr, board, view)
+        return
+    n = board.n
+    rows, cols = view.size(y, stdscr, n, cell_width)
+    top, left = view.top, view.left
+    if full:
+        ncgrid(y, x, stdscr, rows, cols, cell_width)
+        board.dirty_cells(True)
+        dirty = (i * n + j for i in range(top, top + rows)
+                           for j in range(left, left + cols))
+    else:
+        dirty = board.dirty_cells()
+    squares = board.squares
+    compact = board.compact
+    pairs, exp_pairs = get_pairs()
+    for ind in dirty:
+        i, j = divmod(ind, n)
+        i -= top
+        j -= left
+        if not (0 <= i < rows and 0 <= j < cols):
+            continue
+        square = squares[ind]
+        if compact:
+            attr = exp_pairs[square]
+            if square:
+                square = 1 << square
+        else:
+            attr = pairs[square.bit_length()]
+        stdscr.addstr(y + 2 * i + 1, x + j * (cell_width + 1) + 1,
+                      render_cell(square, cell_width, False, True), attr)
+
+def ncstats(y, x, stdscr, profile):
+    """
+    Draw the counts of a Profile over whatever's on screen.
+    """
+    height, width = stdscr.getmaxyx()
+    for i, line in enumerate(profile.report()):
+        if y + i < height:
+            stdscr.addnstr(y + i, x, line.ljust(width), max(0, width - x - 1),
+                           curses.A_REVERSE)
+
+def open_board(n, bitboard, compact, parallel, seed, load):
+    """
+    Make the board to play on, or load it.
+    """
+    if load is not None:
+        return tfe_save.load(load, compact, bitboard, processes=parallel)
+    if bitboard:
+        return BitBoard(seed)
+    if parallel is not None:
+        return ParallelTFEBoard(n, parallel, seed=seed)
+    return TFEBoard(n, seed=seed, compact=compact)
 
-def main(stdscr, n, allow_arrows, auto, auto_chunk):
+def main(stdscr, board, allow_arrows, auto, auto_strategy, auto_chunk,
+         auto_depth, auto_target_ms, fps, history_cells, save, autosave,
+         record, profile, profile_out):
     """
     The main function, to be wrapped by curses
     """
     curses.curs_set(False)
     if auto:
         stdscr.nodelay(True)
-    board = TFEBoard(n)
+    log = MoveLog.begin(board) if record is not None else None
+    if profile:
+        profile = Profile()
+        # a BitBoard can't be profiled, so then only drawing is counted
+        if isinstance(board, TFEBoard):
+            board.set_profile(profile)
+    else:
+        profile = None
+    show_stats = False
+    last_save = perf_counter()
+
+    def save_all():
+        """
+        Save the game and the move log, whichever are wanted.
+        """
+        if save is not None:
+            tfe_save.save(board, save)
+        if log is not None:
+            log.write(record)
+
+    def maybe_autosave():
+        """
+        Save the game if it's been long enough since the last time.
+        """
+        nonlocal last_save
+        if autosave is not None and perf_counter() - last_save >= autosave:
+            save_all()
+            last_save = perf_counter()
+
+    def after_move(move):
+        """
+        Record a move made by the autoplay thread.
+        """
+        if log is not None:
+            log.record(board, move)
+        maybe_autosave()
+
+    if auto:
+        player = make_player(auto_strategy, board, auto_depth)
     move_map = {}
-    for move, action, key in zip("HJKL", [board.left, board.down,
-                                          board.up, board.right],
+    for move, action, key in zip("HJKL", ["left", "down", "up", "right"],
                                          [curses.KEY_LEFT,
                                           curses.KEY_DOWN,
                                           curses.KEY_UP,
@@ -82,43 +469,152 @@ def main(stdscr, n, allow_arrows, auto, auto_chunk):
         move_map[ord(move.lower())] = action
         if allow_arrows:
             move_map[key] = action
+    # panning the viewport, as (dy, dx, page). hjkl are only free for this in
+    # autoplay, and the arrow keys only if they aren't used for moving.
+    pan_map = {}
+    for pan, (dy, dx), key in zip("hjkl", [(0, -1), (1, 0), (-1, 0), (0, 1)],
+                                          [curses.KEY_LEFT,
+                                           curses.KEY_DOWN,
+                                           curses.KEY_UP,
+                                           curses.KEY_RIGHT]):
+        if auto:
+            pan_map[ord(pan)] = dy, dx, False
+            pan_map[ord(pan.upper())] = dy, dx, True
+        if not allow_arrows:
+            pan_map[key] = dy, dx, False
     for ind, i in enumerate(ANSI_VALS, 1):
             curses.init_pair(ind, *reversed(i))
+    view = Viewport()
+    history = History(history_cells)
+    # the position to go back to when the next move is undone, taken once a
+    # move has been made rather than on every key
+    current = None if auto else board.snapshot()
+    # with --fps, the game is played by another thread, and what's shown is a
+    # snapshot of it
+    if fps:
+        stdscr.nodelay(False)
+        engine = AutoThread(board, player, after_move)
+        shown = BoardSnapshot(board.n, board.compact)
+        engine.start()
+    else:
+        engine = None
+        shown = board
+    # the grid is only drawn when this is set
+    full = True
+    # game steps per second, as measured over the last chunk
+    rate = None
     while True:
-        stdscr.refresh()
-        stdscr.erase()
-        stdscr.addstr(0, 0, "Score: {}".format(board.score))
-        ncfmt(1, 0, stdscr, board)
+        frame_start = perf_counter()
+        if engine is not None:
+            engine.snapshot(shown)
+        stdscr.addstr(0, 0, "Score: {}".format(shown.score))
+        if rate is not None:
+            stdscr.addstr("  ({:.0f} steps/s)".format(rate))
+        stdscr.clrtoeol()
+        ncfmt(1, 0, stdscr, shown, full=full, view=view, profile=profile)
+        if show_stats:
+            ncstats(1, 0, stdscr, profile)
+        full = False
+        if engine is not None:
+            # wait for a key for whatever's left of this frame
+            stdscr.timeout(max(0, int((1 / fps - (perf_counter() - frame_start))
+                                        * 1000)))
         c = stdscr.getch()
         if c in {ord("q"), ord("Q"), curses.ascii.ESC}:
             break
         # automatically redraw after window resize
         elif c in {curses.KEY_RESIZE, curses.ascii.ctrl(ord("L"))}:
             stdscr.clear()
+            full = True
+        elif c in pan_map:
+            view.pan(1, stdscr, board.n, *pan_map[c])
+            stdscr.erase()
+            full = True
+        elif c in {ord("z"), ord("Z")}:
+            view.zoom(1, stdscr, board.n)
+            stdscr.erase()
+            full = True
+        elif c in {ord("p"), ord("P")} and profile is not None:
+            show_stats = not show_stats
+            stdscr.erase()
+            full = True
+        elif engine is not None:
+            if engine.stopped.is_set():
+                break
         elif auto:
             i_want_to_break_free = False
+            steps = 0
             for _ in range(auto_chunk):
-                for move in [board.left, board.up, board.right, board.down]:
-                    if move():
-                        break
-                else:
+                move = player.best_move()
+                if move is None:
                     i_want_to_break_free = True
                     break
+                getattr(board, move)()
+                if log is not None:
+                    log.record(board, move)
+                steps += 1
             if i_want_to_break_free:
                 break
-        else:
-            if c in move_map:
-                move_map[c]()
+            elapsed = perf_counter() - frame_start
+            rate = steps / elapsed
+            if auto_target_ms is not None:
+                # scale the chunk towards the target, but not too abruptly
+                scale = min(2, max(0.5, auto_target_ms / 1000 / elapsed))
+                auto_chunk = max(1, round(auto_chunk * scale))
+            maybe_autosave()
+        elif c in move_map:
+            if getattr(board, move_map[c])():
+                history.push(current)
+                current = board.snapshot(current)
+                if log is not None:
+                    log.record(board, move_map[c])
+                maybe_autosave()
+            if not board.can_move():
+                break
+        elif c in {ord("u"), ord("U")}:
+            snap = history.pop()
+            if snap is not None:
+                board.restore(snap)
+                current = snap
+                if log is not None:
+                    log.pop()
+    if engine is not None:
+        engine.stopped.set()
+        engine.join()
+        stdscr.timeout(-1)
     if auto:
         stdscr.nodelay(False)
-    stdscr.erase()
-    stdscr.addstr(0, 0, "GAME OVER: {}".format(board.score),
-                  curses.color_pair(1))
-    ncfmt(1, 0, stdscr, board)
+    # the board can still be looked around once the game is over
+    pan_map.update((ord(pan), move) for pan, move in zip("hjklHJKL", [
+                    (0, -1, False), (1, 0, False), (-1, 0, False),
+                    (0, 1, False), (0, -1, True), (1, 0, True),
+                    (-1, 0, True), (0, 1, True)]))
     while True:
-        if stdscr.getch() in {ord("q"), ord("Q"), curses.ascii.ESC}:
+        stdscr.erase()
+        stdscr.addstr(0, 0, "GAME OVER: {}".format(board.score),
+                      curses.color_pair(1))
+        ncfmt(1, 0, stdscr, board, full=True, view=view)
+        c = stdscr.getch()
+        if c in {ord("q"), ord("Q"), curses.ascii.ESC}:
             break
+        elif c in pan_map:
+            view.pan(1, stdscr, board.n, *pan_map[c])
+        elif c in {ord("z"), ord("Z")}:
+            view.zoom(1, stdscr, board.n)
+    save_all()
+    if profile_out is not None:
+        with open(profile_out, "w") as f:
+            json.dump(profile.as_dict(), f, indent=2)
 
 if __name__ == "__main__":
-    args = get_args()
-    curses.wrapper(lambda stdscr: main(stdscr, **vars(args)))
+    args = vars(get_args())
+    board = open_board(*(args.pop(name) for name in ("n", "bitboard", "compact",
+                                                      "parallel", "seed",
+                                                      "load")))
+    # a ParallelTFEBoard's workers and shared memory have to be let go of
+    # however the game ends
+    try:
+        curses.wrapper(lambda stdscr: main(stdscr, board, **args))
+    finally:
+        if isinstance(board, ParallelTFEBoard):
+            board.close()
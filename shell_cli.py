@@ -4,7 +4,10 @@ Simple shell-like interface to a TFEboard
 
 import argparse
 
-from tfe_base import TFEBoard
+from tfe_base import TFEBoard, History, DEFAULT_HISTORY_CELLS
+from tfe_bitboard import BitBoard
+import tfe_save
+from tfe_replay import MoveLog
 
 def get_args():
     """
@@ -13,29 +16,89 @@ def get_args():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("--no-ansi", dest="ansi", action="store_false",
             help="Don't use ansi codes to colour squares")
+    parser.add_argument("--bitboard", action="store_true",
+            help="Use the packed 4x4 board implementation")
+    parser.add_argument("--seed", type=int, default=None,
+            help="Seed for the random tiles")
+    parser.add_argument("--history-cells", type=int,
+            default=DEFAULT_HISTORY_CELLS,
+            help="Number of cells to keep in the undo history")
+    parser.add_argument("--load", metavar="PATH",
+            help="Carry on with a saved game")
+    parser.add_argument("--save", metavar="PATH",
+            help="Save the game here when quitting")
+    parser.add_argument("--record", metavar="PATH",
+            help="Record a move log here when quitting, for tfe_replay.py")
     parser.add_argument("n", type=int, nargs="?", default=4,
-            help="Board size")
-    return parser.parse_args()
+            help="Board size (ignored with --load)")
+    args = parser.parse_args()
+    if args.load is not None and args.seed is not None:
+        parser.error("--seed can't be used with --load")
+    if args.bitboard and args.n != 4:
+        parser.error("--bitboard only supports a board size of 4")
+    return args
 
-MOVES = {"H": TFEBoard.left,
-         "J": TFEBoard.down,
-         "K": TFEBoard.up,
-         "L": TFEBoard.right}
+# looked up by name, so that any board implementation can be used
+MOVES = {"H": "left",
+         "J": "down",
+         "K": "up",
+         "L": "right"}
 
-def play(n, ansi):
+def play(n, ansi, bitboard=False, seed=None,
+         history_cells=DEFAULT_HISTORY_CELLS, load=None, save=None,
+         record=None):
     """
     Play a round of 2048
     """
-    board = TFEBoard(n)
-    while True:
+    if load is not None:
+        board = tfe_save.load(load, bitboard=bitboard)
+    elif bitboard:
+        board = BitBoard(seed)
+    else:
+        board = TFEBoard(n, seed=seed)
+    log = MoveLog.begin(board) if record is not None else None
+    try:
+        play_board(board, ansi, history_cells, log)
+    finally:
+        # save even if the game is left with ^C or ^D
+        if save is not None:
+            tfe_save.save(board, save)
+        if log is not None:
+            log.write(record)
+
+def play_board(board, ansi, history_cells=DEFAULT_HISTORY_CELLS, log=None):
+    """
+    Play on a given board until the game is over, recording moves in `log` if
+    given
+    """
+    history = History(history_cells)
+    # the position to go back to when the next move is undone
+    current = board.snapshot()
+    while board.can_move():
         print("Score: {}".format(board.score))
         print(board.w_fmt(ansi=ansi))
         move = input().upper()
         if move in MOVES:
-            MOVES[move](board)
+            if getattr(board, MOVES[move])():
+                history.push(current)
+                current = board.snapshot(current)
+                if log is not None:
+                    log.record(board, MOVES[move])
+        elif move == "U":
+            snap = history.pop()
+            if snap is None:
+                print("nothing to undo")
+            else:
+                board.restore(snap)
+                current = snap
+                if log is not None:
+                    log.pop()
         else:
             print("invalid move: {!r}".format(move))
+    print("GAME OVER: {}".format(board.score))
+    print(board.w_fmt(ansi=ansi))
 
 if __name__ == "__main__":
     args = get_args()
-    play(args.n, args.ansi)
+    play(args.n, args.ansi, args.bitboard, args.seed, args.history_cells,
+         args.load, args.save, args.record)
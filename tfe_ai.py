@@ -0,0 +1,116 @@
+"""
+Automatic players for a TFEBoard. Each player is made with the board it plays
+on, and its best_move method gives the name of the move it wants to make next,
+or None if there is no move left.
+"""
+
+from tfe_base import DIRECTIONS
+
+STRATEGIES = ("simple", "expectimax")
+
+DEFAULT_DEPTH = 2
+# spawn branches less likely than this are evaluated with the heuristic instead
+# of being searched further
+DEFAULT_PROB_CUTOFF = 1e-3
+
+# chance of a new tile being a 2 or a 4, as in TFEBoard.add_random
+SPAWNS = ((2, 0.9), (4, 0.1))
+
+def default_heuristic(state, n):
+    """
+    Rewards empty squares and monotonic rows and columns, scaled by the biggest
+    tile so that it is comparable to the score.
+    """
+    mono = 0
+    for i in range(n):
+        for line in state[i * n:(i + 1) * n], state[i::n]:
+            inc = sum(a <= b for a, b in zip(line, line[1:]))
+            mono += max(inc, n - 1 - inc)
+    return max(state) * (state.count(0) + mono / n)
+
+class SimplePlayer:
+    """
+    Go left, up, right or down, in order of preference.
+    """
+    def __init__(self, board):
+        self.board = board
+
+    def best_move(self):
+        """
+        Pick the first legal move.
+        """
+        moves = self.board.legal_moves()
+        return moves[0] if moves else None
+
+class ExpectimaxPlayer:
+    """
+    Depth-limited expectimax search over moves and random tiles. Positions are
+    expanded with TFEBoard.preview, and values are cached in a transposition
+    table for the duration of each search.
+    """
+    def __init__(self, board, depth=DEFAULT_DEPTH, heuristic=default_heuristic,
+                 prob_cutoff=DEFAULT_PROB_CUTOFF):
+        if not isinstance(board.squares, list):
+            raise TypeError("expectimax needs a board with a list of squares")
+        self.board = board
+        self.depth = depth
+        self.heuristic = heuristic
+        self.prob_cutoff = prob_cutoff
+        self.table = {}
+
+    def best_move(self):
+        """
+        Search for the move with the best expected value.
+        """
+        self.table.clear()
+        best = None
+        best_val = None
+        for direction in DIRECTIONS:
+            result = self.board.preview(direction)
+            if result.moved:
+                val = result.gain + self.chance_val(result.state, self.depth, 1)
+                if best_val is None or val > best_val:
+                    best, best_val = direction, val
+        return best
+
+    def max_val(self, state, depth, prob):
+        """
+        Value of a position where it's our turn to move.
+        """
+        best_val = 0
+        for direction in DIRECTIONS:
+            result = self.board.preview(direction, state)
+            if result.moved:
+                best_val = max(best_val,
+                               result.gain
+                                   + self.chance_val(result.state, depth, prob))
+        return best_val
+
+    def chance_val(self, state, depth, prob):
+        """
+        Value of a position where a random tile is about to be added, with
+        probability `prob` of being reached.
+        """
+        if depth == 0 or prob < self.prob_cutoff:
+            return self.heuristic(state, self.board.n)
+        key = (tuple(state), depth)
+        if key in self.table:
+            return self.table[key]
+        empty = [ind for ind, i in enumerate(state) if i == 0]
+        total = 0
+        for ind in empty:
+            for tile, tile_prob in SPAWNS:
+                state[ind] = tile
+                total += tile_prob * self.max_val(
+                            state, depth - 1, prob * tile_prob / len(empty))
+            state[ind] = 0
+        val = self.table[key] = total / len(empty)
+        return val
+
+def make_player(strategy, board, depth=DEFAULT_DEPTH):
+    """
+    Make a player for `board` by the name of its strategy.
+    """
+    if strategy == "expectimax":
+        return ExpectimaxPlayer(board, depth)
+    return SimplePlayer(board)
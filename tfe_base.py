@@ -3,9 +3,19 @@ Base class for 2048. UI implementation is left to the caller, although this
 class does provide some string formatting.
 """
 
-from itertools import repeat, chain, starmap
-from random import choice, random
+import os
+import pickle
+from itertools import repeat, starmap, product, chain
+from random import Random
 from functools import lru_cache
+from collections import namedtuple, deque, Counter, OrderedDict
+from time import perf_counter
+
+# compiled sifting for compact boards, if tfe_speedups.c has been built
+try:
+    import tfe_speedups
+except ImportError:
+    tfe_speedups = None
 
 # the xterm-256 type colours to be used in SGR escapes to colour tiles.
 ANSI_VALS = [
@@ -16,30 +26,502 @@ ANSI_VALS = [
 
 ANSI_ESCS = list(starmap("\x1b[48;5;{}m\x1b[38;5;{}m".format, ANSI_VALS))
 
-def ilog(n, base=2):
+# colour for each tile by its bit_length (0 for an empty square, and exponent +
+# 1 otherwise), to be used as an index into ANSI_ESCS or as a curses colour pair
+# number. Covers every tile a compact square, being a byte, can hold.
+COLOUR_INDEX = [min(bits, len(ANSI_VALS) - 1) for bits in range(257)]
+# the same, by the exponent stored in a compact square
+EXP_COLOUR_INDEX = [COLOUR_INDEX[0], *COLOUR_INDEX[2:]]
+
+# biggest tile exponent precomputed by a LineTable, by default. On a 4x4 board
+# that's 13 ** 4 lines, which is quick enough to build.
+DEFAULT_TABLE_EXP = 12
+# version of the entries of a LineTable, so that old disk caches aren't used
+LINE_TABLE_VERSION = 3
+
+MASK64 = (1 << 64) - 1
+# increment of the SplitMix64 generator, used by CounterRNG
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+# number of cells an undo History holds on to, by default
+DEFAULT_HISTORY_CELLS = 10 ** 6
+
+# names of the moves, in the order the autoplayer prefers them
+DIRECTIONS = ("left", "up", "right", "down")
+
+# total size in characters (which, being ASCII, is about the size in bytes) of
+# the whole-board templates kept around, and the biggest single one worth
+# making. Bigger boards are formatted a row at a time instead.
+TEMPL_CACHE_SIZE = 1 << 24
+MAX_TEMPL_SIZE = 1 << 20
+
+def make_templ(n, cell_width):
+    """
+    Make a template for str.format for a board, with a field for each rendered
+    cell, in the most ghastly one-liner I could possibly think of.
     """
-    Simple iterative integer logarithm.
-    Even though there's a loop, this is linear in the number of bits of the
-    input, so basically pretty fast
+    return ("{}\n".format("{}".join(repeat("|", (n + 1))))
+                        .join(repeat(make_sep(n, cell_width), n + 1)))
+
+def make_sep(n, cell_width):
+    """
+    The line between rows of a board, with its newline.
     """
-    exp = 0
-    while n > 0:
-        n //= base
-        exp += 1
-    return exp
+    return "{}\n".format(("-" * cell_width).join("+" * (n + 1)))
 
-# cached to speed it up
+# cached to speed it up, and only O(n) in size
 @lru_cache()
-def make_templ(n, cell_width):
+def make_row_templ(n, cell_width):
+    """
+    Make a template for one row of rendered cells and the line under it, to be
+    used n times after a make_sep line.
+    """
+    return "{}\n{}".format("{}".join(repeat("|", (n + 1))),
+                           make_sep(n, cell_width))
+
+def templ_size(n, cell_width):
+    """
+    Size of the template make_templ would make, without making it.
+    """
+    return ((n + 1) * (n * (cell_width + 1) + 2)
+                + n * (3 * n + 2))
+
+class TemplateCache:
+    """
+    Least recently used cache of board templates, bounded by their total size
+    rather than by their number.
+    """
+    def __init__(self, max_size=TEMPL_CACHE_SIZE):
+        self.max_size = max_size
+        self.templs = OrderedDict()
+        self.size = 0
+
+    def get(self, n, cell_width):
+        """
+        Get the template from make_templ, or None if it's over MAX_TEMPL_SIZE,
+        in which case the row template should be used instead.
+        """
+        key = n, cell_width
+        templ = self.templs.get(key)
+        if templ is not None:
+            self.templs.move_to_end(key)
+            return templ
+        size = templ_size(n, cell_width)
+        if size > min(MAX_TEMPL_SIZE, self.max_size):
+            return None
+        templ = self.templs[key] = make_templ(n, cell_width)
+        self.size += size
+        while self.size > self.max_size:
+            _, old = self.templs.popitem(last=False)
+            self.size -= len(old)
+        return templ
+
+TEMPLATES = TemplateCache()
+
+# there are only ever a few distinct tiles, so this stays small
+@lru_cache(maxsize=None)
+def render_cell(value, cell_width, ansi, hide_z):
+    """
+    The text of a cell holding the tile `value`, padded to cell_width, and
+    coloured if `ansi` is given. Empty cells are blank if `hide_z` is given.
+    """
+    return "{}{:{}}{}".format(
+                ANSI_ESCS[COLOUR_INDEX[value.bit_length()]] if ansi else '',
+                value or ' ' if hide_z else value,
+                cell_width,
+                "\x1b[0m" if ansi else '')
+
+def sift_line(squares, seq, empty=None, exponents=False):
+    """
+    Sift the squares in the list `squares` down the indices in `seq`, returning
+    whether anything moved and the score gained. If an EmptyIndex is given, it
+    is kept up to date. If `exponents` is given, the squares hold the log2 of
+    the tiles rather than the tiles themselves.
+
+    This is done in a single forward pass, keeping a write cursor for the next
+    free index and a register holding the last tile written that is still
+    allowed to merge. Once a tile has merged the register is cleared, which is
+    how each tile is prevented from merging more than once.
+    """
+    # flag to track if anything changed
+    any_moved = False
+    gain = 0
+    write = 0
+    # value of the tile at seq[write - 1], if it hasn't merged yet
+    last = 0
+    for ind, i in enumerate(seq):
+        sift_square = squares[i]
+        if sift_square == 0:
+            continue
+        if sift_square == last:
+            any_moved = True
+            if exponents:
+                squares[seq[write - 1]] = sift_square + 1
+                gain += 1 << (sift_square + 1)
+            else:
+                squares[seq[write - 1]] = sift_square * 2
+                gain += sift_square * 2
+            squares[i] = 0
+            if empty is not None:
+                empty.add(i)
+            # the merged tile may not merge again
+            last = 0
+        else:
+            if write != ind:
+                any_moved = True
+                squares[seq[write]] = sift_square
+                squares[i] = 0
+                if empty is not None:
+                    empty.replace(seq[write], i)
+            last = sift_square
+            write += 1
+    return any_moved, gain
+
+def table_line(seq):
+    """
+    The range `seq` as used by TFEBoard.sift_lookup: a tuple of the range, its
+    start, its step, and the slice picking out its squares.
+    """
+    # a reversed range can stop at -1, which means something else in a slice
+    stop = seq.stop if seq.stop >= 0 else None
+    return seq, seq.start, seq.step, slice(seq.start, stop, seq.step)
+
+def nth_empty(squares, k):
+    """
+    Index of the kth (from 0) empty square in row-major order.
+    """
+    ind = squares.index(0)
+    for _ in range(k):
+        ind = squares.index(0, ind + 1)
+    return ind
+
+def line_can_move(squares, seq):
+    """
+    Check whether sifting down the indices in `seq` would change anything,
+    without actually doing it. That's the case exactly if some tile has a gap
+    before it, or is equal to the tile before it.
+    """
+    seen_empty = False
+    last = 0
+    for i in seq:
+        square = squares[i]
+        if square == 0:
+            seen_empty = True
+        elif seen_empty or square == last:
+            return True
+        else:
+            last = square
+    return False
+
+class EmptyIndex:
+    """
+    The set of indices of empty squares, supporting O(1) insertion, removal and
+    random choice. Stored as a list of the indices, along with the position of
+    each index within that list (or -1).
+    """
+    def __init__(self, squares):
+        self.cells = [ind for ind, i in enumerate(squares) if i == 0]
+        self.pos = [-1] * len(squares)
+        for p, ind in enumerate(self.cells):
+            self.pos[ind] = p
+
+    def add(self, ind):
+        """
+        Mark a square as empty.
+        """
+        self.pos[ind] = len(self.cells)
+        self.cells.append(ind)
+
+    def remove(self, ind):
+        """
+        Mark a square as not empty, by moving the last index into its place.
+        """
+        p = self.pos[ind]
+        last = self.cells.pop()
+        if last != ind:
+            self.cells[p] = last
+            self.pos[last] = p
+        self.pos[ind] = -1
+
+    def replace(self, old, new):
+        """
+        Mark `old` as not empty and `new` as empty, in one step.
+        """
+        p = self.pos[old]
+        self.cells[p] = new
+        self.pos[new] = p
+        self.pos[old] = -1
+
+    def set_order(self, cells):
+        """
+        Put the empty squares in the order given by `cells`, as copied from
+        another index of the same squares.
+        """
+        self.cells = list(cells)
+        pos = [-1] * len(self.pos)
+        for p, ind in enumerate(self.cells):
+            pos[ind] = p
+        self.pos = pos
+
+    def choice(self, rng):
+        """
+        Pick a random empty square, using the random.Random-like `rng`.
+        """
+        return rng.choice(self.cells)
+
+    def __contains__(self, ind):
+        return self.pos[ind] != -1
+
+    def __len__(self):
+        return len(self.cells)
+
+class CountingEmptyIndex(EmptyIndex):
+    """
+    EmptyIndex that also counts every square vacated by a tile moving or
+    merging away, into the tiles_moved of a Profile.
+    """
+    def __init__(self, squares, profile):
+        super().__init__(squares)
+        self.profile = profile
+
+    def add(self, ind):
+        self.profile.tiles_moved += 1
+        super().add(ind)
+
+    def replace(self, old, new):
+        self.profile.tiles_moved += 1
+        super().replace(old, new)
+
+class UpdateLog:
+    """
+    Stands in for an EmptyIndex in sift_line, recording the calls made to it
+    as pairs of (old, new) for replace or (ind, -1) for add.
+    """
+    def __init__(self):
+        self.updates = []
+
+    def add(self, ind):
+        self.updates.append((ind, -1))
+
+    def replace(self, old, new):
+        self.updates.append((old, new))
+
+def splitmix64(x):
+    """
+    The SplitMix64 output function, which scrambles a 64-bit integer.
+    """
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+class CounterRNG:
+    """
+    Counter-based random number generator: the ith draw is a pure function of
+    the seed and i, namely SplitMix64. That makes it cheap to reproduce
+    elsewhere, eg. vectorised in the batch engine. Implements the parts of the
+    random.Random interface that the boards use.
+    """
+    def __init__(self, seed=0):
+        self.seed = seed & MASK64
+        self.counter = 0
+
+    def next64(self):
+        """
+        Get the next 64-bit output.
+        """
+        self.counter += 1
+        return splitmix64((self.seed + self.counter * GOLDEN_GAMMA) & MASK64)
+
+    def random(self):
+        """
+        Random float in [0, 1), from the top 53 bits of the next output.
+        """
+        return (self.next64() >> 11) * 2 ** -53
+
+    def randrange(self, stop):
+        """
+        Random integer in [0, stop). This goes through random() so that it's
+        easy to replicate with floating point arrays.
+        """
+        return int(self.random() * stop)
+
+    def choice(self, seq):
+        """
+        Random element of a non-empty sequence.
+        """
+        return seq[self.randrange(len(seq))]
+
+    def getstate(self):
+        """
+        Get the state, which can be passed to setstate to resume from here.
+        """
+        return self.seed, self.counter
+
+    def setstate(self, state):
+        """
+        Restore a state from getstate.
+        """
+        self.seed, self.counter = state
+
+class LineTable:
+    """
+    Lookup table mapping the contents of a line of length n, as a tuple, to the
+    result of sifting it towards index 0. That's () if the line doesn't move,
+    and otherwise a tuple (result, score gain, updates), where updates are the
+    calls sift_line makes to an EmptyIndex, in order, as offsets in the line:
+    (old, new) for replace and (ind, -1) for add. Replaying them in that order
+    leaves the index just as sifting would, so new tiles go in the same places.
+
+    Every line made of tiles up to 2 ** max_exp is precomputed, lazily, the
+    first time the table is used. Lines with bigger tiles are sifted on demand
+    and then remembered. If `cache_path` is given the precomputed table is
+    loaded from there, or written there after being built.
+    """
+    def __init__(self, n, max_exp=DEFAULT_TABLE_EXP, cache_path=None):
+        self.n = n
+        self.max_exp = max_exp
+        self.cache_path = cache_path
+        self.table = None
+
+    @staticmethod
+    def compute(line):
+        """
+        Actually sift a line, to make an entry for the table.
+        """
+        squares = list(line)
+        log = UpdateLog()
+        any_moved, gain = sift_line(squares, range(len(squares)), log)
+        if not any_moved:
+            return ()
+        return tuple(squares), gain, tuple(log.updates)
+
+    def build(self):
+        """
+        Fill in the table, from the disk cache if there is a usable one.
+        """
+        header = (LINE_TABLE_VERSION, self.n, self.max_exp)
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            with open(self.cache_path, "rb") as f:
+                cached = pickle.load(f)
+            if cached[:-1] == header:
+                self.table = cached[-1]
+                return
+        values = [0, *(2 ** exp for exp in range(1, self.max_exp + 1))]
+        self.table = {line: self.compute(line)
+                        for line in product(values, repeat=self.n)}
+        if self.cache_path is not None:
+            with open(self.cache_path, "wb") as f:
+                pickle.dump((*header, self.table), f, pickle.HIGHEST_PROTOCOL)
+
+    def lookup(self, line):
+        """
+        Get the entry for a line, given as a tuple.
+        """
+        if self.table is None:
+            self.build()
+        try:
+            return self.table[line]
+        except KeyError:
+            entry = self.table[line] = self.compute(line)
+            return entry
+
+# result of previewing a move: the state after sifting (without a random square
+# added), the score gained, and whether anything moved.
+Preview = namedtuple("Preview", ["state", "gain", "moved"])
+
+# saved state of a board: the score, the state of its RNG, its rows, and the
+# order of its empty square index (or None if it doesn't have one).
+Snapshot = namedtuple("Snapshot", ["score", "rng_state", "rows", "empty"])
+
+class History:
+    """
+    Bounded undo history of board snapshots. Consecutive snapshots share their
+    unchanged rows, so memory is accounted for in the cells each snapshot holds
+    on to by itself, and the oldest snapshots are dropped once the total goes
+    over max_cells.
+    """
+    def __init__(self, max_cells=DEFAULT_HISTORY_CELLS):
+        self.max_cells = max_cells
+        self.snaps = deque()
+        # cells held only by each snapshot, and in total
+        self.own = deque()
+        self.cells = 0
+
+    def push(self, snap):
+        """
+        Add a snapshot, dropping old ones if that makes the history too big.
+        """
+        # rows shared with the snapshot now on top aren't counted again
+        prev_rows = self.snaps[-1].rows if self.snaps else repeat(None)
+        own = sum(len(row) for row, old in zip(snap.rows, prev_rows)
+                    if row is not old)
+        if snap.empty is not None:
+            own += len(snap.empty)
+        self.snaps.append(snap)
+        self.own.append(own)
+        self.cells += own
+        while self.cells > self.max_cells and len(self.snaps) > 1:
+            old = self.snaps.popleft()
+            own = self.own.popleft()
+            # rows the next snapshot shares are now only held by that one
+            shared = sum(len(row) for old_row, row
+                                    in zip(old.rows, self.snaps[0].rows)
+                                    if old_row is row)
+            self.own[0] += shared
+            self.cells -= own - shared
+
+    def pop(self):
+        """
+        Take off the most recent snapshot, or return None if there isn't one.
+        """
+        if not self.snaps:
+            return None
+        self.cells -= self.own.pop()
+        return self.snaps.pop()
+
+    def __len__(self):
+        return len(self.snaps)
+
+class Profile:
     """
-    Make a template for str.format for a board, in the most ghastly one-liner I
-    could possibly think of.
+    Opt-in counters of where the time goes: the number of calls to, and total
+    time spent in, each phase (such as "sift", "add_random" or "draw"), and
+    the number of tiles moved and merged by sifting.
     """
-    return ("{}\n".format(
-                "{{}}{{:{}}}{{}}".format(cell_width)
-                    .join(repeat("|", (n + 1))))
-                        .join(repeat("{}\n".format(("-" * cell_width)
-                            .join("+" * (n + 1))), n + 1)))
+    def __init__(self):
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.tiles_moved = 0
+        self.merges = 0
+
+    def add(self, phase, seconds):
+        """
+        Count a call to a phase which took `seconds`.
+        """
+        self.calls[phase] += 1
+        self.seconds[phase] += seconds
+
+    def report(self):
+        """
+        Format the counters as a list of lines.
+        """
+        lines = ["{:<10} {:>10} calls {:>10.3f}s {:>10.1f}us/call".format(
+                    phase, self.calls[phase], self.seconds[phase],
+                    self.seconds[phase] / self.calls[phase] * 1e6)
+                        for phase in sorted(self.calls)]
+        lines.append("tiles moved {}, merges {}".format(self.tiles_moved,
+                                                       self.merges))
+        return lines
+
+    def as_dict(self):
+        """
+        The counters as a dict, ready for JSON.
+        """
+        return {"phases": {phase: {"calls": self.calls[phase],
+                                   "seconds": self.seconds[phase]}
+                                for phase in sorted(self.calls)},
+                "tiles_moved": self.tiles_moved,
+                "merges": self.merges}
 
 class GameOver(Exception):
     """
@@ -49,13 +531,50 @@ class GameOver(Exception):
 
 class TFEBoard:
     """
-    A 2048 board
+    A 2048 board. If a LineTable is given, moves are done by looking lines up
+    in it, which is a little faster for small boards. New tiles are drawn from
+    `rng`, which defaults to a random.Random with the given seed.
+
+    If `compact` is given, squares is a bytearray of the log2 of each tile (or
+    0), which is far smaller and quicker to copy than a list of ints. Values are
+    only decoded for display, by tile_values. Compact boards are sifted by the
+    compiled tfe_speedups module, if it has been built.
+
+    If `canonical` is given, new tiles go in the kth empty square in row-major
+    order, rather than the kth in the empty square index. That takes a scan
+    of the board per tile, but places the same tiles as BitBoard and
+    BatchTFEBoard do with the same RNG, so it can be checked against them.
     """
-    def __init__(self, n):
+    def __init__(self, n, line_table=None, seed=None, rng=None, compact=False,
+                 canonical=False):
         self.n = n
+        self.compact = compact
+        self.canonical = canonical
         self.score = 0
-        # safe because 0 is immutable
-        self.squares = [0] * n ** 2
+        self.rng = Random(seed) if rng is None else rng
+        # lines changed since the last call to dirty_cells, as increasing
+        # ranges (of one square for a new tile), or None for every square
+        self.changed = None
+        # Profile counting into, if any, as set by set_profile
+        self.profile = None
+        # the last snapshot taken or restored, and the rows changed since (or
+        # None for all of them), so snapshot only has to copy those
+        self.snapped = None
+        self.dirty_rows = None
+        if line_table is not None and line_table.n != n:
+            raise ValueError("line table is for size {}, not {}"
+                                .format(line_table.n, n))
+        if line_table is not None and compact:
+            raise ValueError("line tables can't be used with compact squares")
+        self.line_table = line_table
+        # the tfe_speedups module, if it's to be used for this board
+        self.speedups = (tfe_speedups if compact and line_table is None
+                            else None)
+        if compact:
+            self.squares = bytearray(n ** 2)
+        else:
+            # safe because 0 is immutable
+            self.squares = [0] * n ** 2
         # sequences of squares to meld, represented as iterables of integers,
         # starting from the "wall" against which to send.
         self.up_seq = [range(i, n ** 2, n) for i in range(n)]
@@ -63,76 +582,305 @@ class TFEBoard:
         self.down_seq = [r[::-1] for r in self.up_seq]
         self.left_seq = [range(i, i + n) for i in range(0, n * n, n)]
         self.right_seq = [r[::-1] for r in self.left_seq]
+        # the lines of each of those, as looked up in the line table, by id
+        if line_table is not None:
+            self.table_lines = {id(seqs): list(map(table_line, seqs))
+                                    for seqs in (self.up_seq, self.down_seq,
+                                                 self.left_seq, self.right_seq)}
+        self.reindex()
+        # square and size of the last tile added, as (loc, four)
+        self.last_spawn = None
         for _ in range(2):
             self.add_random()
 
+    def reindex(self):
+        """
+        Rebuild the index of empty squares. This needs to be called after
+        assigning to squares directly.
+        """
+        self.dirty_rows = None
+        self.changed = None
+        if self.profile is None:
+            self.empty = EmptyIndex(self.squares)
+        else:
+            self.empty = CountingEmptyIndex(self.squares, self.profile)
+
+    def set_profile(self, profile):
+        """
+        Start counting sifts and new tiles into a Profile, or stop if it's None.
+        The empty square index keeps its order, so the game isn't changed.
+        """
+        cells = self.empty.cells
+        self.profile = profile
+        if profile is None:
+            self.empty = EmptyIndex(self.squares)
+        else:
+            self.empty = CountingEmptyIndex(self.squares, profile)
+        self.empty.set_order(cells)
+
     def add_random(self):
         """
         Randomly insert a new tile, with 90% chance of being a 2, and 10% chance
         of being a 4.
         """
-        available = [ind for ind, i in enumerate(self.squares) if i == 0]
+        if self.profile is not None:
+            start = perf_counter()
         # currently this isn't actually ever reached.
-        if not available:
+        if not self.empty:
             raise GameOver("The board is full.")
-        loc = choice(available)
-        if random() < 0.9:
-            self.squares[loc] = 2
+        if self.canonical:
+            loc = self.nth_empty(self.rng.randrange(len(self.empty)))
+            self.place(loc, self.rng.random() >= 0.9)
+        elif self.speedups is not None:
+            self.last_spawn = self.speedups.add_random(
+                    self.squares, self.empty.cells, self.empty.pos, self.rng)
+            loc = self.last_spawn[0]
+            if self.dirty_rows is not None:
+                self.dirty_rows.add(loc // self.n)
+            if self.changed is not None:
+                self.changed.add(range(loc, loc + 1))
+        else:
+            loc = self.empty.choice(self.rng)
+            self.place(loc, self.rng.random() >= 0.9)
+        if self.profile is not None:
+            self.profile.add("add_random", perf_counter() - start)
+
+    def nth_empty(self, k):
+        """
+        Index of the kth (from 0) empty square in row-major order, for placing
+        tiles on a canonical board.
+        """
+        return nth_empty(self.squares, k)
+
+    def place(self, loc, four):
+        """
+        Put a new 2 (or a 4 if `four`) in the empty square `loc`, remembering
+        it as last_spawn.
+        """
+        self.empty.remove(loc)
+        if four:
+            self.squares[loc] = 2 if self.compact else 4
+        else:
+            self.squares[loc] = 1 if self.compact else 2
+        self.last_spawn = (loc, four)
+        if self.dirty_rows is not None:
+            self.dirty_rows.add(loc // self.n)
+        if self.changed is not None:
+            self.changed.add(range(loc, loc + 1))
+
+    def mark_dirty(self, seq):
+        """
+        Note that the squares in `seq` have changed, for snapshot and
+        dirty_cells. A row is marked on its own for snapshot, and anything else
+        marks every row. Anything but a range marks every square for
+        dirty_cells.
+        """
+        if self.dirty_rows is not None:
+            if isinstance(seq, range) and seq.step in (1, -1):
+                self.dirty_rows.add(seq.start // self.n)
+            else:
+                self.dirty_rows = None
+        if self.changed is not None:
+            if isinstance(seq, range):
+                self.changed.add(seq if seq.step > 0 else seq[::-1])
+            else:
+                self.changed = None
+
+    def snapshot(self, prev=None):
+        """
+        Save the state of the board, to be brought back with restore. Only
+        rows changed since the last snapshot was taken or restored are copied,
+        and the rest are shared with it. Copied rows that are the same as in the
+        snapshot `prev` are shared with that instead.
+        """
+        squares = self.squares
+        n = self.n
+        if self.snapped is None or self.dirty_rows is None:
+            rows = [None] * n
+            dirty = range(n)
         else:
-            self.squares[loc] = 4
+            rows = list(self.snapped.rows)
+            dirty = self.dirty_rows
+        for i in dirty:
+            row = squares[i * n:i * n + n]
+            if prev is not None and prev.rows[i] == row:
+                row = prev.rows[i]
+            rows[i] = row
+        # the order of the empty square index decides where new tiles go, so
+        # it's kept too, for a restored board to carry on identically
+        empty = self.empty.cells[:]
+        snap = Snapshot(self.score, self.rng.getstate(), tuple(rows), empty)
+        self.snapped = snap
+        self.dirty_rows = set()
+        return snap
+
+    def restore(self, snap):
+        """
+        Go back to the state saved in a snapshot.
+        """
+        n = self.n
+        for start, row in zip(range(0, n * n, n), snap.rows):
+            self.squares[start:start + n] = row
+        self.score = snap.score
+        self.rng.setstate(snap.rng_state)
+        self.empty.set_order(snap.empty)
+        self.snapped = snap
+        self.dirty_rows = set()
+        self.changed = None
+
+    def tile_values(self):
+        """
+        The squares as tile values, decoding them if they're stored compactly.
+        """
+        if not self.compact:
+            return self.squares
+        return [1 << exp if exp else 0 for exp in self.squares]
+
+    def can_move(self):
+        """
+        Check whether any move is possible. This is O(1) unless the board is
+        full, in which case it looks for adjacent equal tiles.
+        """
+        if self.empty:
+            return True
+        squares = self.squares
+        return any(squares[a] == squares[b]
+                        for seqs in (self.left_seq, self.up_seq)
+                        for seq in seqs
+                        for a, b in zip(seq, seq[1:]))
+
+    def legal_moves(self):
+        """
+        List the names of the moves that would change the board, in the order
+        of DIRECTIONS.
+        """
+        squares = self.squares
+        return [direction for direction in DIRECTIONS
+                    if any(line_can_move(squares, seq)
+                        for seq in getattr(self, direction + "_seq"))]
+
+    def preview(self, direction, state=None):
+        """
+        Work out the result of moving in the given direction, without changing
+        the board or adding a random square. `state` can be a list of squares to
+        use instead of the board's own, for search.
+        """
+        squares = (self.squares if state is None else state)[:]
+        gain = 0
+        any_moved = False
+        seqs = getattr(self, direction + "_seq")
+        if self.line_table is not None:
+            for _, _, _, where in self.table_lines[id(seqs)]:
+                entry = self.line_table.lookup(tuple(squares[where]))
+                if entry:
+                    squares[where] = entry[0]
+                    gain += entry[1]
+                    any_moved = True
+            return Preview(squares, gain, any_moved)
+        for seq in seqs:
+            moved, line_gain = sift_line(squares, seq, exponents=self.compact)
+            gain += line_gain
+            any_moved = moved or any_moved
+        return Preview(squares, gain, any_moved)
 
     def sift(self, seq):
         """
         Sift squares down the indices in `seq`.
         """
-        # flag to track if anything changed
+        if self.speedups is not None:
+            any_moved, gain, moved = self.speedups.sift_all(
+                    self.squares, (seq,), self.empty.cells, self.empty.pos)
+            if self.profile is not None:
+                self.profile.tiles_moved += moved
+        else:
+            any_moved, gain = sift_line(self.squares, seq, self.empty,
+                                        self.compact)
+        if any_moved:
+            self.mark_dirty(seq)
+        self.score += gain
+        return any_moved
+
+    def sift_lookup(self, lines):
+        """
+        Sift each of `lines`, as made by table_line, by looking up the result
+        in the line table rather than actually sifting. The result is put in
+        with a single slice assignment, and the index gets the same updates
+        sift_line would have made.
+        """
+        line_table = self.line_table
+        if line_table.table is None:
+            line_table.build()
+        table = line_table.table
+        squares = self.squares
+        empty = self.empty
         any_moved = False
-        for ind, i in enumerate(seq):
-            prev_i = i
-            sift_square = self.squares[i]
-            if sift_square != 0:
-                # even though this looks terrible, it should be basically really
-                # fast because it's all implemented with range arithmetic (in C)
-                for step_i in seq[:ind][::-1]:
-                    target_square = self.squares[step_i]
-                    if target_square <= 0:
-                        any_moved = True
-                        self.squares[step_i] = sift_square
-                        self.squares[prev_i] = 0
-                        if target_square == -1:
-                            break
-                    else:
-                        if target_square == sift_square:
-                            any_moved = True
-                            self.squares[step_i] = sift_square * 2
-                            self.score += sift_square * 2
-                            # -1 here flags that this square has already merged
-                            self.squares[prev_i] = -1
-                        break
-                    prev_i = step_i
-        # clean up -1s
-        for i in seq:
-            if self.squares[i] == -1:
-                self.squares[i] = 0
+        for seq, start, step, where in lines:
+            line = tuple(squares[where])
+            entry = table.get(line)
+            if entry is None:
+                entry = line_table.lookup(line)
+            if not entry:
+                continue
+            result, gain, updates = entry
+            squares[where] = result
+            for old, new in updates:
+                if new < 0:
+                    empty.add(start + old * step)
+                else:
+                    empty.replace(start + old * step, start + new * step)
+            self.mark_dirty(seq)
+            self.score += gain
+            any_moved = True
         return any_moved
 
-    def sift_all(self, seqs):
+    def sift_all(self, seqs, spawn=True):
         """
-        Sift for each seq in seqs, and then add another random square. Basically
-        functions as a "turn".
+        Sift for each seq in seqs, and then add another random square (unless
+        `spawn` is false). Basically functions as a "turn".
         """
         # Check if anything moved. Could be done with a list comprehension and
         # any(), but that's a waste of space and I'm not going to unironically
         # use a deque here.
         any_moved = False
-        for seq in seqs:
-            # Make sure not to short-circuit
-            any_moved = self.sift(seq) or any_moved
+        profile = self.profile
+        if profile is not None:
+            start = perf_counter()
+            # every merge frees up a square, and nothing else does
+            empties = len(self.empty)
+        if self.speedups is not None:
+            # lines that moved
+            lines = []
+            any_moved, gain, moved = self.speedups.sift_all(
+                    self.squares, seqs, self.empty.cells, self.empty.pos, lines)
+            for k in lines:
+                self.mark_dirty(seqs[k])
+            self.score += gain
+            if profile is not None:
+                # not counted by the index, as it's updated directly
+                profile.tiles_moved += moved
+        elif self.line_table is not None and id(seqs) in self.table_lines:
+            any_moved = self.sift_lookup(self.table_lines[id(seqs)])
+        else:
+            for seq in seqs:
+                # Make sure not to short-circuit
+                any_moved = self.sift(seq) or any_moved
+        if profile is not None:
+            profile.add("sift", perf_counter() - start)
+            profile.merges += len(self.empty) - empties
         # only add another if the move had some effect
-        if any_moved:
+        if any_moved and spawn:
             self.add_random()
         return any_moved
 
+    def replay_move(self, direction, loc, four):
+        """
+        Move in the given direction, and then put in the tile given by `loc`
+        and `four` (as in place) rather than a random one. Used to replay
+        recorded games.
+        """
+        self.sift_all(getattr(self, direction + "_seq"), spawn=False)
+        self.place(loc, four)
+
     def up(self):
         """
         Sift up
@@ -157,18 +905,48 @@ class TFEBoard:
         """
         return self.sift_all(self.right_seq)
 
+    def dirty_cells(self, full=False):
+        """
+        Get the indices of the squares that have changed since the last call,
+        for redrawing, from the lines marked as they moved and the new tiles.
+        If `full` is given, or on the first call, that's all of them. Squares
+        in both a moved row and a moved column come up twice.
+        """
+        changed = self.changed
+        self.changed = set()
+        if full or changed is None:
+            return range(len(self.squares))
+        return chain.from_iterable(changed)
+
     def w_fmt(self, cell_width=7, ansi=False, hide_z=True):
         """
         Separate method because it supports various other flags
         """
-        return (make_templ(self.n, cell_width)
-                    .format(
-                        *chain.from_iterable(
-                                (ANSI_ESCS[min(ilog(s), len(ANSI_ESCS) - 1)]
-                                    if ansi else '',
-                                 s or ' ' if hide_z else s,
-                                 "\x1b[0m" if ansi else '')
-                                for s in self.squares)))
+        n = self.n
+        cells = map(render_cell, self.tile_values(), repeat(cell_width),
+                    repeat(ansi), repeat(hide_z))
+        templ = TEMPLATES.get(n, cell_width)
+        if templ is not None:
+            return templ.format(*cells)
+        row = make_row_templ(n, cell_width)
+        cells = list(cells)
+        return make_sep(n, cell_width) + "".join(
+                    row.format(*cells[start:start + n])
+                        for start in range(0, n * n, n))
+
+    def write_to(self, stream, cell_width=7, ansi=False, hide_z=True):
+        """
+        Write the same thing as w_fmt to `stream` a row at a time, so that the
+        whole string never has to be built for a big board.
+        """
+        n = self.n
+        row = make_row_templ(n, cell_width)
+        values = self.tile_values()
+        stream.write(make_sep(n, cell_width))
+        for start in range(0, n * n, n):
+            stream.write(row.format(*map(render_cell, values[start:start + n],
+                                         repeat(cell_width), repeat(ansi),
+                                         repeat(hide_z))))
 
     def __str__(self):
         """
@@ -192,6 +970,7 @@ if __name__ == "__main__":
                 board.squares[i] = ind
         print(board)
         board.squares = [0] * len(board.squares)
+    board.reindex()
     for _ in range(10):
         board.add_random()
     for direc in board.up, board.down, board.left, board.right:
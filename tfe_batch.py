@@ -0,0 +1,132 @@
+"""
+Batch 2048 engine, which steps many boards of the same size at once using
+NumPy. Intended for Monte Carlo type evaluation, rather than for playing.
+"""
+
+import numpy as np
+
+from tfe_base import MASK64, GOLDEN_GAMMA
+
+def splitmix64(x):
+    """
+    The SplitMix64 output function, on an array of uint64. Same as
+    tfe_base.splitmix64, relying on wrapping multiplication.
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def compact(lines):
+    """
+    Move the nonzero squares of every line to the front, keeping their order.
+    """
+    order = np.argsort(lines == 0, axis=1, kind="stable")
+    return np.take_along_axis(lines, order, axis=1)
+
+def sift_lines(lines):
+    """
+    Sift every line in the 2-D array `lines` towards index 0, returning the new
+    lines and the score gained by each line.
+    """
+    lines = compact(lines)
+    gain = np.zeros(lines.shape[0], dtype=lines.dtype)
+    # merging left to right, and zeroing the right hand square of each merge,
+    # stops any tile from merging twice.
+    for i in range(lines.shape[1] - 1):
+        merge = (lines[:, i] == lines[:, i + 1]) & (lines[:, i] != 0)
+        lines[merge, i] *= 2
+        lines[merge, i + 1] = 0
+        gain[merge] += lines[merge, i]
+    return compact(lines), gain
+
+class BatchTFEBoard:
+    """
+    k 2048 boards of size n, stored as one (k, n, n) array of tile values.
+    Moves are applied to all boards at once, and return a boolean array of
+    which boards changed.
+
+    Board i draws its random numbers from the same stream as a
+    CounterRNG(seed + i), and picks the empty square for a new tile in
+    row-major order, so it places the same tiles as a BitBoard or a canonical
+    TFEBoard with that RNG.
+    """
+    def __init__(self, k, n, seed=0):
+        self.k = k
+        self.n = n
+        self.seeds = np.array([(seed + i) & MASK64 for i in range(k)],
+                              dtype=np.uint64)
+        self.counters = np.zeros(k, dtype=np.uint64)
+        self.scores = np.zeros(k, dtype=np.int64)
+        self.squares = np.zeros((k, n, n), dtype=np.int64)
+        everything = np.ones(k, dtype=bool)
+        for _ in range(2):
+            self.add_random(everything)
+
+    def random(self, boards):
+        """
+        Draw a random float in [0, 1) for each board in the index array
+        `boards`, like CounterRNG.random.
+        """
+        self.counters[boards] += np.uint64(1)
+        out = splitmix64(self.seeds[boards]
+                            + self.counters[boards] * np.uint64(GOLDEN_GAMMA))
+        return (out >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+    def add_random(self, mask):
+        """
+        Randomly insert a new tile into each board selected by the boolean
+        array `mask`, with 90% chance of being a 2, and 10% chance of being a 4.
+        Full boards are left alone.
+        """
+        flat = self.squares.reshape(self.k, -1)
+        empty = flat == 0
+        counts = empty.sum(axis=1)
+        boards = np.flatnonzero(mask & (counts > 0))
+        picks = (self.random(boards) * counts[boards]).astype(np.int64)
+        # index of the picks-th empty square
+        locs = (empty[boards].cumsum(axis=1) > picks[:, None]).argmax(axis=1)
+        flat[boards, locs] = np.where(self.random(boards) < 0.9, 2, 4)
+
+    def sift_all(self, view):
+        """
+        Sift every line of `view` (a view of squares, oriented so that the
+        "wall" is at index 0 of the last axis), and then add another random
+        square to each board that changed. Basically functions as a "turn".
+        """
+        old = view.reshape(-1, self.n)
+        new, gain = sift_lines(old)
+        moved = (new != old).reshape(self.k, -1).any(axis=1)
+        view[...] = new.reshape(view.shape)
+        self.scores += gain.reshape(self.k, self.n).sum(axis=1)
+        self.add_random(moved)
+        return moved
+
+    def up(self):
+        """
+        Sift up
+        """
+        return self.sift_all(self.squares.transpose(0, 2, 1))
+
+    def down(self):
+        """
+        Sift down
+        """
+        return self.sift_all(self.squares.transpose(0, 2, 1)[:, :, ::-1])
+
+    def left(self):
+        """
+        Sift left
+        """
+        return self.sift_all(self.squares)
+
+    def right(self):
+        """
+        Sift right
+        """
+        return self.sift_all(self.squares[:, :, ::-1])
+
+    def __repr__(self):
+        """
+        Very bare representation.
+        """
+        return "BatchTFEBoard({}, {})".format(self.k, self.n)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the 2048 engines across board sizes: sifting in each direction,
+adding random tiles, formatting with w_fmt and write_to, and playing games.
+Results are printed as JSON, so that runs under different interpreters or
+versions of the engine can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+from functools import lru_cache
+from random import Random
+from time import perf_counter
+
+from tfe_base import TFEBoard, LineTable, DIRECTIONS
+from tfe_bitboard import BitBoard
+from tfe_ai import STRATEGIES, DEFAULT_DEPTH, make_player
+
+DEFAULT_SIZES = (4, 8, 32, 128, 512)
+
+# the line table and bitboard only make sense for small boards
+ENGINES = ("list", "compact", "table", "bitboard")
+ENGINE_SIZES = {"table": (4,), "bitboard": (4,)}
+
+@lru_cache()
+def line_table(n):
+    """
+    Line table shared by every board of size n, so it's only built once.
+    """
+    return LineTable(n)
+
+def make_board(engine, n, seed):
+    """
+    Make a board of the given engine and size.
+    """
+    if engine == "bitboard":
+        return BitBoard(seed)
+    if engine == "table":
+        return TFEBoard(n, line_table=line_table(n), seed=seed)
+    return TFEBoard(n, seed=seed, compact=engine == "compact")
+
+def random_squares(board, rng):
+    """
+    Squares for a half-full board of small tiles, in the board's own storage.
+    """
+    exps = [rng.randrange(1, 7) if rng.random() < 0.5 else 0
+                for _ in range(board.n ** 2)]
+    if board.compact:
+        return bytearray(exps)
+    return [1 << exp if exp else 0 for exp in exps]
+
+def set_squares(board, squares):
+    """
+    Put a copy of `squares` on the board.
+    """
+    board.squares = squares[:]
+    board.reindex()
+
+def sifter(board, direction):
+    """
+    Function sifting the board in the given direction without adding a tile.
+    """
+    if isinstance(board, BitBoard):
+        def sift():
+            board.board = board.slide(direction)[0]
+    else:
+        seqs = getattr(board, direction + "_seq")
+        def sift():
+            board.sift_all(seqs, spawn=False)
+    return sift
+
+def time_calls(func, setup=None, min_time=0.2, max_calls=10000):
+    """
+    Mean time per call of func, calling it until at least `min_time` seconds
+    have been spent in it (or `max_calls` calls made). `setup` is called
+    untimed before each call.
+    """
+    # warm up, so that tables and templates built on first use aren't counted
+    if setup is not None:
+        setup()
+    func()
+    total = 0
+    calls = 0
+    while calls < max_calls and (total < min_time or not calls):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        func()
+        total += perf_counter() - start
+        calls += 1
+    return {"calls": calls, "seconds": total / calls}
+
+def bench_game(engine, n, strategy, depth, seed, min_time, max_moves):
+    """
+    Play games back to back until `min_time` has passed, or for up to
+    `max_moves` moves, and measure the throughput. Games on big boards last
+    far longer than `min_time`, so they're stopped part way through.
+    """
+    moves = 0
+    games = 0
+    finished = 0
+    start = perf_counter()
+    while perf_counter() - start < min_time and moves < max_moves:
+        board = make_board(engine, n, seed + games)
+        player = make_player(strategy, board, depth)
+        games += 1
+        while perf_counter() - start < min_time and moves < max_moves:
+            move = player.best_move()
+            if move is None:
+                finished += 1
+                break
+            getattr(board, move)()
+            moves += 1
+    elapsed = perf_counter() - start
+    return {"games": games, "finished": finished, "moves": moves,
+            "seconds": elapsed, "moves_per_second": moves / elapsed}
+
+def bench(engine, n, strategies, depth, seed, min_time, max_moves):
+    """
+    Run every benchmark for one engine and board size.
+    """
+    rng = Random(seed)
+    board = make_board(engine, n, seed)
+    start = random_squares(board, rng)
+    result = {"engine": engine, "n": n, "sift": {}}
+
+    def reset():
+        set_squares(board, start)
+    for direction in DIRECTIONS:
+        result["sift"][direction] = time_calls(sifter(board, direction),
+                                               reset, min_time)
+    reset()
+
+    def clear():
+        # take away the last tile added, so the board doesn't fill up
+        if board.last_spawn is not None:
+            loc = board.last_spawn[0]
+            if isinstance(board, BitBoard):
+                board.board &= ~(0xF << (4 * loc))
+            else:
+                board.squares[loc] = 0
+                board.empty.add(loc)
+            board.last_spawn = None
+    result["add_random"] = time_calls(board.add_random, clear, min_time)
+    reset()
+    result["w_fmt"] = time_calls(lambda: board.w_fmt(ansi=True),
+                                 min_time=min_time)
+    with open(os.devnull, "w") as null:
+        result["write_to"] = time_calls(lambda: board.write_to(null, ansi=True),
+                                        min_time=min_time)
+    result["game"] = {}
+    for strategy in strategies:
+        if strategy == "expectimax" and (engine != "list" or n > 4):
+            continue
+        result["game"][strategy] = bench_game(engine, n, strategy, depth,
+                                              seed, min_time, max_moves)
+    return result
+
+def get_args():
+    """
+    Parse arg
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+",
+            default=list(DEFAULT_SIZES),
+            help="Board sizes to benchmark")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES,
+            default=list(ENGINES),
+            help="Engines to benchmark. The line table and bitboard are only "
+                 "run for n = 4")
+    parser.add_argument("--strategies", nargs="+", choices=STRATEGIES,
+            default=["simple"],
+            help="Strategies to measure game throughput with. Expectimax is "
+                 "only run on the list engine for n = 4")
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH,
+            help="Search depth for the expectimax strategy")
+    parser.add_argument("--min-time", type=float, default=0.2,
+            help="Seconds to spend on each measurement")
+    parser.add_argument("--max-moves", type=int, default=100000,
+            help="Most moves to make when measuring game throughput")
+    parser.add_argument("--seed", type=int, default=0,
+            help="Seed for the boards and random tiles")
+    parser.add_argument("--output", metavar="PATH",
+            help="Write the results here rather than to stdout")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    results = []
+    for n in args.sizes:
+        for engine in args.engines:
+            if n in ENGINE_SIZES.get(engine, (n,)):
+                results.append(bench(engine, n, args.strategies, args.depth,
+                                     args.seed, args.min_time, args.max_moves))
+                print("done {} n={}".format(engine, n), file=sys.stderr)
+    report = {"implementation": platform.python_implementation(),
+              "version": platform.python_version(),
+              "platform": platform.platform(),
+              "min_time": args.min_time,
+              "results": results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
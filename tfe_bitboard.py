@@ -0,0 +1,317 @@
+"""
+Alternative 2048 board for the 4x4 case, storing the whole board as sixteen
+4-bit exponents packed into a single int. Exposes the same interface as a
+TFEBoard, so the front ends can use either.
+"""
+
+from random import Random
+
+from tfe_base import TFEBoard, GameOver, Preview, Snapshot, DIRECTIONS
+
+# the biggest exponent that fits in a nibble. Two of these can't merge, as the
+# result wouldn't fit, which caps tiles at 32768.
+MAX_EXP = 0xF
+
+ROW_MASK = 0xFFFF
+ROW_SHIFTS = (0, 16, 32, 48)
+
+# low bit of each nibble
+NIBBLE_LOW = 0x1111111111111111
+
+def reverse_row(row):
+    """
+    Reverse the order of the four nibbles in a 16-bit row.
+    """
+    return (((row & 0xF) << 12) | ((row & 0xF0) << 4)
+            | ((row >> 4) & 0xF0) | (row >> 12))
+
+def transpose(board):
+    """
+    Transpose a packed board, where cell (r, c) lives in nibble 4 * r + c. Done
+    by swapping 2x2 blocks of nibbles, and then swapping nibbles within those.
+    """
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+def empty_mask(board):
+    """
+    Mask with the low bit of every empty nibble set.
+    """
+    board |= (board >> 2) & 0x3333333333333333
+    board |= board >> 1
+    return ~board & NIBBLE_LOW
+
+def sift_row(row):
+    """
+    Sift a 16-bit row towards its lowest nibble, returning the new row and the
+    score gained.
+    """
+    exps = [(row >> shift) & 0xF for shift in (0, 4, 8, 12)]
+    result = []
+    gain = 0
+    # exponent of the last tile placed, if it hasn't merged yet
+    last = 0
+    for exp in exps:
+        if exp == 0:
+            continue
+        if exp == last and exp != MAX_EXP:
+            result[-1] = exp + 1
+            gain += 2 ** (exp + 1)
+            last = 0
+        else:
+            result.append(exp)
+            last = exp
+    return sum(exp << shift for exp, shift in zip(result, (0, 4, 8, 12))), gain
+
+def build_row_tables():
+    """
+    Make the tables of results of sifting every possible row left or right,
+    and the score gained from doing so.
+    """
+    left = [0] * (ROW_MASK + 1)
+    score = [0] * (ROW_MASK + 1)
+    for row in range(ROW_MASK + 1):
+        left[row], score[row] = sift_row(row)
+    right = [reverse_row(left[reverse_row(row)]) for row in range(ROW_MASK + 1)]
+    right_score = [score[reverse_row(row)] for row in range(ROW_MASK + 1)]
+    return left, score, right, right_score
+
+# built on first use, as it takes a moment
+ROW_TABLES = None
+
+def get_row_tables():
+    """
+    Get the row tables, building them if necessary.
+    """
+    global ROW_TABLES
+    if ROW_TABLES is None:
+        ROW_TABLES = build_row_tables()
+    return ROW_TABLES
+
+class BitBoard:
+    """
+    A 4x4 2048 board packed into a single int. New tiles are drawn from `rng`,
+    which defaults to a random.Random with the given seed.
+    """
+    n = 4
+    # squares are given as tile values, even though they're stored as exponents
+    compact = False
+
+    def __init__(self, seed=None, rng=None):
+        self.score = 0
+        self.rng = Random(seed) if rng is None else rng
+        # copy of the squares as of the last call to dirty_cells
+        self.drawn = None
+        self.board = 0
+        # square and size of the last tile added, as (loc, four)
+        self.last_spawn = None
+        for _ in range(2):
+            self.add_random()
+
+    @property
+    def squares(self):
+        """
+        The tile values as a flat row-major list, like TFEBoard.squares. This
+        is a fresh list, so assigning into it doesn't affect the board.
+        """
+        board = self.board
+        return [1 << exp if exp else 0
+                    for exp in ((board >> shift) & 0xF
+                                    for shift in range(0, 64, 4))]
+
+    @squares.setter
+    def squares(self, squares):
+        board = 0
+        for shift, square in zip(range(0, 64, 4), squares):
+            if square:
+                board |= (square.bit_length() - 1) << shift
+        self.board = board
+
+    def snapshot(self, prev=None):
+        """
+        Save the state of the board, to be brought back with restore. The
+        whole board is a single row of 8 bytes.
+        """
+        row = self.board.to_bytes(8, "little")
+        if prev is not None and prev.rows[0] == row:
+            return Snapshot(self.score, self.rng.getstate(), prev.rows, None)
+        return Snapshot(self.score, self.rng.getstate(), (row,), None)
+
+    def restore(self, snap):
+        """
+        Go back to the state saved in a snapshot.
+        """
+        self.board = int.from_bytes(snap.rows[0], "little")
+        self.score = snap.score
+        self.rng.setstate(snap.rng_state)
+
+    def tile_values(self):
+        """
+        The squares as tile values.
+        """
+        return self.squares
+
+    def reindex(self):
+        """
+        Empty squares are always found in order, so there's no index to
+        rebuild.
+        """
+        pass
+
+    def empty_count(self):
+        """
+        Number of empty cells on the board.
+        """
+        return bin(empty_mask(self.board)).count("1")
+
+    def add_random(self):
+        """
+        Randomly insert a new tile, with 90% chance of being a 2, and 10% chance
+        of being a 4.
+        """
+        mask = empty_mask(self.board)
+        count = bin(mask).count("1")
+        if not count:
+            raise GameOver("The board is full.")
+        # skip past a random number of empty cells
+        for _ in range(self.rng.randrange(count)):
+            mask &= mask - 1
+        low = mask & -mask
+        self.place((low.bit_length() - 1) // 4, self.rng.random() >= 0.9)
+
+    def place(self, loc, four):
+        """
+        Put a new 2 (or a 4 if `four`) in the empty square `loc`, remembering
+        it as last_spawn.
+        """
+        self.board |= (2 if four else 1) << (4 * loc)
+        self.last_spawn = (loc, four)
+
+    def slide(self, direction, board=None):
+        """
+        Work out the board and score gained from sifting in the given direction,
+        without changing anything or adding a random square. `board` can be a
+        packed board to use instead of this one's.
+        """
+        left, left_score, right, right_score = get_row_tables()
+        if board is None:
+            board = self.board
+        if direction in ("up", "down"):
+            board = transpose(board)
+        if direction in ("left", "up"):
+            table, score_table = left, left_score
+        else:
+            table, score_table = right, right_score
+        new = 0
+        gain = 0
+        for shift in ROW_SHIFTS:
+            row = (board >> shift) & ROW_MASK
+            new |= table[row] << shift
+            gain += score_table[row]
+        if direction in ("up", "down"):
+            new = transpose(new)
+        return new, gain
+
+    def preview(self, direction, state=None):
+        """
+        Work out the result of moving in the given direction, as a Preview whose
+        state is a packed board.
+        """
+        if state is None:
+            state = self.board
+        new, gain = self.slide(direction, state)
+        return Preview(new, gain, new != state)
+
+    def move(self, direction):
+        """
+        Sift in the given direction, adding a random square if the move had any
+        effect.
+        """
+        new, gain = self.slide(direction)
+        if new == self.board:
+            return False
+        self.board = new
+        self.score += gain
+        self.add_random()
+        return True
+
+    def replay_move(self, direction, loc, four):
+        """
+        Move in the given direction, and then put in the tile given by `loc`
+        and `four` (as in place) rather than a random one. Used to replay
+        recorded games.
+        """
+        new, gain = self.slide(direction)
+        self.board = new
+        self.score += gain
+        self.place(loc, four)
+
+    def can_move(self):
+        """
+        Check whether any move is possible.
+        """
+        return bool(empty_mask(self.board)) or bool(self.legal_moves())
+
+    def legal_moves(self):
+        """
+        List the names of the moves that would change the board, in the order
+        of DIRECTIONS.
+        """
+        return [direction for direction in DIRECTIONS
+                    if self.slide(direction)[0] != self.board]
+
+    def up(self):
+        """
+        Sift up
+        """
+        return self.move("up")
+
+    def down(self):
+        """
+        Sift down
+        """
+        return self.move("down")
+
+    def left(self):
+        """
+        Sift left
+        """
+        return self.move("left")
+
+    def right(self):
+        """
+        Sift right
+        """
+        return self.move("right")
+
+    def dirty_cells(self, full=False):
+        """
+        Get the indices of the squares that have changed since the last call,
+        for redrawing, by comparing them with a copy. If `full` is given, or on
+        the first call, that's all of them.
+        """
+        squares = self.squares
+        if full or self.drawn is None:
+            dirty = range(16)
+        else:
+            dirty = [ind for ind, (old, new)
+                        in enumerate(zip(self.drawn, squares)) if old != new]
+        self.drawn = squares
+        return dirty
+
+    # formatting only goes through n and squares, so can be shared
+    w_fmt = TFEBoard.w_fmt
+    write_to = TFEBoard.write_to
+    __str__ = TFEBoard.__str__
+
+    def __repr__(self):
+        """
+        Very bare representation.
+        """
+        return "BitBoard()"
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+Differential check of the compiled tfe_speedups module against the pure Python
+engine: pairs of compact boards, one using each, are played with the same
+random moves, undos and replayed tiles, and must agree exactly at every step,
+down to the order of their empty square indices. Boards with a line table are
+checked against plain boards in the same way.
+"""
+
+import argparse
+import sys
+from random import Random
+
+import tfe_base
+from tfe_base import (TFEBoard, LineTable, CounterRNG, Profile, DIRECTIONS,
+                      GameOver)
+
+def state(board):
+    """
+    Everything that has to match between the two boards.
+    """
+    return (list(board.squares), board.score, board.empty.cells,
+            board.empty.pos, board.last_spawn, board.rng.getstate())
+
+def check_game(n, seed, counter_rng, profile, moves, line_table=None):
+    """
+    Play one pair of games, returning a description of the first difference,
+    or None if there wasn't one. The pair is a plain board and one with the
+    given LineTable if there is one, or else a compact board in pure Python
+    and one using tfe_speedups.
+    """
+    boards = []
+    if line_table is None:
+        for speedups in (None, tfe_base.tfe_speedups):
+            rng = CounterRNG(seed) if counter_rng else None
+            board = TFEBoard(n, seed=seed, rng=rng, compact=True)
+            board.speedups = speedups
+            boards.append(board)
+    else:
+        for table in (None, line_table):
+            rng = CounterRNG(seed) if counter_rng else None
+            boards.append(TFEBoard(n, table, seed=seed, rng=rng))
+    if profile:
+        for board in boards:
+            board.set_profile(Profile())
+    slow, fast = boards
+    rng = Random(seed)
+    snaps = []
+    for turn in range(moves):
+        action = rng.random()
+        try:
+            if action < 0.05 and snaps:
+                snap = snaps.pop()
+                for board in boards:
+                    board.restore(snap)
+                what = "restore"
+            elif action < 0.1:
+                snaps.append(slow.snapshot())
+                fast.snapshot()
+                what = "snapshot"
+            elif action < 0.15:
+                seq = rng.choice(getattr(slow, rng.choice(DIRECTIONS) + "_seq"))
+                results = [board.sift(seq) for board in boards]
+                what = "sift {}".format(seq)
+            elif action < 0.2:
+                direction = rng.choice(DIRECTIONS)
+                results = [board.sift_all(getattr(board, direction + "_seq"),
+                                          spawn=False)
+                                for board in boards]
+                what = "{} without a new tile".format(direction)
+            else:
+                direction = rng.choice(DIRECTIONS)
+                results = [getattr(board, direction)() for board in boards]
+                what = direction
+        except GameOver:
+            break
+        if action >= 0.1 and results[0] != results[1]:
+            return "turn {} ({}): returned {} and {}".format(turn, what,
+                                                             *results)
+        if state(slow) != state(fast):
+            return "turn {} ({}): boards differ".format(turn, what)
+        if profile and (slow.profile.tiles_moved != fast.profile.tiles_moved
+                        or slow.profile.merges != fast.profile.merges):
+            return "turn {} ({}): profiles differ".format(turn, what)
+        if not slow.can_move():
+            break
+    return None
+
+def get_args():
+    """
+    Parse arg
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--games", type=int, default=200,
+            help="Number of pairs of games to play")
+    parser.add_argument("--moves", type=int, default=2000,
+            help="Most moves to make in each game")
+    parser.add_argument("--seed", type=int, default=0,
+            help="Base seed. Game i is played with seed + i")
+    parser.add_argument("--table-games", type=int, default=50,
+            help="Number of pairs of 4x4 games to play with and without a "
+                 "line table")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    table_failures = 0
+    line_table = LineTable(4)
+    for i in range(args.table_games):
+        seed = args.seed + i
+        counter_rng = bool(i % 2)
+        profile = i % 3 == 0
+        diff = check_game(4, seed, counter_rng, profile, args.moves, line_table)
+        if diff is not None:
+            table_failures += 1
+            print("table seed={} counter_rng={} profile={}: {}".format(
+                    seed, counter_rng, profile, diff))
+    print("{} of {} table games differed".format(table_failures,
+                                                 args.table_games))
+    if tfe_base.tfe_speedups is None:
+        sys.exit("tfe_speedups hasn't been built (see tfe_speedups.c)")
+    failures = table_failures
+    for i in range(args.games):
+        seed = args.seed + i
+        n = (2, 3, 4, 5, 8, 13, 32)[i % 7]
+        counter_rng = bool(i % 2)
+        profile = i % 3 == 0
+        diff = check_game(n, seed, counter_rng, profile, args.moves)
+        if diff is not None:
+            failures += 1
+            print("n={} seed={} counter_rng={} profile={}: {}".format(
+                    n, seed, counter_rng, profile, diff))
+    print("{} of {} games differed".format(failures - table_failures,
+                                           args.games))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,337 @@
+"""
+Compact 2048 board for huge boards, which sifts its lines across a pool of
+worker processes. The lines of a move don't affect each other, so each worker
+sifts a contiguous chunk of them, in place, in the shared memory holding the
+board's squares.
+
+Keeping an EmptyIndex up to date would mean a serial update for every tile
+moved, so instead the board only keeps the number of empty squares in each
+row, which the workers count for their own chunks as they go. New tiles go in
+the kth empty square in row-major order, as the board is canonical, so a
+ParallelTFEBoard places the same tiles as a compact canonical TFEBoard with
+the same RNG, however many processes it has.
+
+If tfe_speedups has been built, workers sift with it.
+"""
+
+import os
+from bisect import bisect_right
+from itertools import accumulate, chain
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+
+import tfe_base
+from tfe_base import TFEBoard, Snapshot, DIRECTIONS, sift_line
+
+# chunks of lines given to each process per move, to even out the work
+CHUNKS_PER_PROCESS = 4
+
+# each worker's view of the shared squares, and the tfe_speedups module if it's
+# to be used
+WORKER_SHM = None
+WORKER_N = None
+WORKER_SPEEDUPS = None
+
+def line_seq(n, direction, i):
+    """
+    Indices of line i for a move in the given direction, as in TFEBoard.
+    """
+    if direction in ("up", "down"):
+        seq = range(i, n * n, n)
+    else:
+        seq = range(i * n, i * n + n)
+    if direction in ("down", "right"):
+        seq = seq[::-1]
+    return seq
+
+def count_empty(squares, n, direction, start, stop):
+    """
+    Count the empty squares in each row of the chunk of lines start to stop
+    for a move in the given direction: rows start to stop for left and right,
+    and the part of every row in columns start to stop for up and down.
+    """
+    if direction in ("left", "right"):
+        return [squares[i * n:i * n + n].tobytes().count(0)
+                    for i in range(start, stop)]
+    return [squares[i + start:i + stop].tobytes().count(0)
+                for i in range(0, n * n, n)]
+
+class MoveCounter:
+    """
+    Stands in for an EmptyIndex in sift_line, only counting the tiles moved.
+    """
+    def __init__(self):
+        self.moved = 0
+
+    def add(self, ind):
+        self.moved += 1
+
+    def replace(self, old, new):
+        self.moved += 1
+
+class RowCounts:
+    """
+    Stands in for an EmptyIndex on a ParallelTFEBoard, as the number of empty
+    squares in each row of `squares`. Finding the kth empty square takes a scan
+    of the counts and of one row, but nothing has to be done per tile moved.
+    Tiles moved are counted into a Profile, if one is given.
+    """
+    def __init__(self, squares, n, profile=None):
+        self.squares = squares
+        self.n = n
+        self.profile = profile
+        self.set_counts(count_empty(squares, n, "left", 0, n))
+
+    def set_counts(self, counts):
+        """
+        Take new counts for every row, as worked out by the workers.
+        """
+        self.counts = counts
+        self.total = sum(counts)
+
+    def add(self, ind):
+        """
+        Mark a square as empty.
+        """
+        if self.profile is not None:
+            self.profile.tiles_moved += 1
+        self.counts[ind // self.n] += 1
+        self.total += 1
+
+    def remove(self, ind):
+        """
+        Mark a square as not empty.
+        """
+        self.counts[ind // self.n] -= 1
+        self.total -= 1
+
+    def replace(self, old, new):
+        """
+        Mark `old` as not empty and `new` as empty, in one step.
+        """
+        if self.profile is not None:
+            self.profile.tiles_moved += 1
+        self.counts[old // self.n] -= 1
+        self.counts[new // self.n] += 1
+
+    def nth(self, k):
+        """
+        Index of the kth (from 0) empty square in row-major order.
+        """
+        ends = list(accumulate(self.counts))
+        i = bisect_right(ends, k)
+        k -= ends[i] - self.counts[i]
+        row = self.squares[i * self.n:i * self.n + self.n].tobytes()
+        j = row.index(0)
+        for _ in range(k):
+            j = row.index(0, j + 1)
+        return i * self.n + j
+
+    def __contains__(self, ind):
+        return self.squares[ind] == 0
+
+    def __len__(self):
+        return self.total
+
+def attach(name, n, speedups):
+    """
+    Pool initialiser, attaching a worker to the shared squares, and telling it
+    whether to sift with tfe_speedups.
+    """
+    global WORKER_SHM, WORKER_N, WORKER_SPEEDUPS
+    WORKER_SHM = SharedMemory(name)
+    WORKER_N = n
+    WORKER_SPEEDUPS = tfe_base.tfe_speedups if speedups else None
+
+def sift_lines(job):
+    """
+    Sift lines start to stop in the given direction, from a (direction, start,
+    stop) tuple, returning whether anything moved, the score gained, the
+    number of tiles moved, the numbers of the lines that moved and the counts
+    of empty squares from count_empty.
+    """
+    direction, start, stop = job
+    squares = WORKER_SHM.buf
+    seqs = [line_seq(WORKER_N, direction, i) for i in range(start, stop)]
+    if WORKER_SPEEDUPS is not None:
+        lines = []
+        any_moved, gain, tiles_moved = WORKER_SPEEDUPS.sift_count(squares,
+                                                                  seqs, lines)
+    else:
+        counter = MoveCounter()
+        any_moved = False
+        gain = 0
+        lines = []
+        for k, seq in enumerate(seqs):
+            moved, line_gain = sift_line(squares, seq, counter, True)
+            if moved:
+                any_moved = True
+                lines.append(k)
+            gain += line_gain
+        tiles_moved = counter.moved
+    return (any_moved, gain, tiles_moved, [start + k for k in lines],
+            count_empty(squares, WORKER_N, direction, start, stop))
+
+class ParallelTFEBoard(TFEBoard):
+    """
+    A compact TFEBoard whose squares live in shared memory, and whose moves
+    are sifted there by `processes` worker processes (one per core by
+    default). Only worth it for boards in the hundreds or more. Call close (or
+    use it as a context manager) to shut the workers down, after which the
+    squares are copied back into a bytearray.
+    """
+    def __init__(self, n, processes=None, seed=None, rng=None):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.shm = SharedMemory(create=True, size=n * n)
+        # the squares, once they've been moved into shared memory by reindex
+        self.shared = self.shm.buf
+        super().__init__(n, seed=seed, rng=rng, compact=True, canonical=True)
+        # tfe_speedups only knows how to update an EmptyIndex, so it's only
+        # used by the workers
+        self.speedups = None
+        self.pool = Pool(processes, attach,
+                         (self.shm.name, n, tfe_base.tfe_speedups is not None))
+        chunks = processes * CHUNKS_PER_PROCESS
+        bounds = [n * k // chunks for k in range(chunks + 1)]
+        # the work for a move in each direction, as jobs for sift_lines
+        self.jobs = {direction: [(direction, start, stop)
+                                    for start, stop in zip(bounds, bounds[1:])
+                                        if start != stop]
+                        for direction in DIRECTIONS}
+        self.directions = {id(getattr(self, direction + "_seq")): direction
+                                for direction in DIRECTIONS}
+
+    def reindex(self):
+        """
+        Recount the empty squares. This needs to be called after assigning to
+        squares directly, and moves them into shared memory.
+        """
+        if self.shared is not None and self.squares is not self.shared:
+            self.shared[:] = self.squares
+            self.squares = self.shared
+        self.dirty_rows = None
+        self.changed = None
+        self.empty = RowCounts(self.squares, self.n, self.profile)
+
+    def nth_empty(self, k):
+        """
+        Index of the kth (from 0) empty square in row-major order, from the
+        counts of empty squares in each row.
+        """
+        return self.empty.nth(k)
+
+    def set_profile(self, profile):
+        """
+        Start counting sifts and new tiles into a Profile, or stop if it's None.
+        """
+        self.profile = profile
+        self.empty.profile = profile
+
+    def snapshot(self, prev=None):
+        """
+        Save the state of the board as in TFEBoard.snapshot, with the rows
+        copied out of shared memory. Nothing is kept for the empty squares, as
+        their order doesn't decide where new tiles go.
+        """
+        n = self.n
+        if self.snapped is None or self.dirty_rows is None:
+            rows = [None] * n
+            dirty = range(n)
+        else:
+            rows = list(self.snapped.rows)
+            dirty = self.dirty_rows
+        for i in dirty:
+            row = self.squares[i * n:i * n + n].tobytes()
+            if prev is not None and prev.rows[i] == row:
+                row = prev.rows[i]
+            rows[i] = row
+        snap = Snapshot(self.score, self.rng.getstate(), tuple(rows), None)
+        self.snapped = snap
+        self.dirty_rows = set()
+        return snap
+
+    def restore(self, snap):
+        """
+        Go back to the state saved in a snapshot.
+        """
+        n = self.n
+        for start, row in zip(range(0, n * n, n), snap.rows):
+            self.squares[start:start + n] = row
+        self.score = snap.score
+        self.rng.setstate(snap.rng_state)
+        self.empty = RowCounts(self.squares, n, self.profile)
+        self.snapped = snap
+        self.dirty_rows = set()
+        self.changed = None
+
+    def preview(self, direction, state=None):
+        """
+        As TFEBoard.preview, working on a copy of the squares out of shared
+        memory.
+        """
+        if state is None:
+            state = bytearray(self.squares)
+        return super().preview(direction, state)
+
+    def sift_all(self, seqs, spawn=True):
+        """
+        Sift for each seq in seqs in the worker processes, and then add another
+        random square (unless `spawn` is false). Seqs other than the board's own
+        are sifted here.
+        """
+        direction = self.directions.get(id(seqs))
+        if direction is None:
+            return super().sift_all(seqs, spawn)
+        profile = self.profile
+        if profile is not None:
+            start = perf_counter()
+            empties = len(self.empty)
+        results = self.pool.map(sift_lines, self.jobs[direction])
+        any_moved = False
+        for moved, gain, tiles_moved, lines, _ in results:
+            any_moved = moved or any_moved
+            self.score += gain
+            if profile is not None:
+                profile.tiles_moved += tiles_moved
+            for i in lines:
+                self.mark_dirty(seqs[i])
+        if direction in ("left", "right"):
+            counts = list(chain.from_iterable(result[-1]
+                                                for result in results))
+        else:
+            # each chunk counted its own columns of every row
+            counts = list(map(sum, zip(*(result[-1] for result in results))))
+        self.empty.set_counts(counts)
+        if profile is not None:
+            profile.add("sift", perf_counter() - start)
+            profile.merges += len(self.empty) - empties
+        if any_moved and spawn:
+            self.add_random()
+        return any_moved
+
+    def close(self):
+        """
+        Shut down the workers and free the shared memory, keeping a copy of the
+        squares.
+        """
+        self.pool.close()
+        self.pool.join()
+        self.squares = bytearray(self.shared)
+        self.empty.squares = self.squares
+        self.shared = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        """
+        Very bare representation.
+        """
+        return "ParallelTFEBoard({})".format(self.n)
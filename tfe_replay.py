@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Replay a recorded 2048 game headless, and show the board as of any turn.
+
+A move log holds the starting board (in the tfe_save format, so including the
+state of the RNG) and then one varint per move, packing the direction with the
+square and size of the tile added after it. New tiles are recorded rather than
+redrawn from the RNG because where they go depends on the order of the empty
+square index, which isn't saved with the starting board (a loaded board
+rebuilds it). That costs a couple of bytes per move on big boards.
+
+Seeking goes from the nearest checkpoint (a board snapshot taken every so many
+turns) rather than from the start.
+"""
+
+import argparse
+import struct
+import sys
+from time import perf_counter
+
+import tfe_save
+from tfe_base import DIRECTIONS
+
+MAGIC = b"2LOG"
+VERSION = 1
+
+# magic, version, size of the starting board
+LOG_HEADER = struct.Struct("<4sBI")
+
+DEFAULT_CHECKPOINT_EVERY = 1000
+
+def encode_move(direction, loc, four):
+    """
+    Pack a move and the tile added after it as a varint.
+    """
+    value = (loc << 3) | (four << 2) | direction
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+def decode_moves(buf):
+    """
+    Unpack varints into a list of (direction, loc, four) tuples.
+    """
+    moves = []
+    value = 0
+    shift = 0
+    for byte in buf:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            moves.append((value & 3, value >> 3, bool(value & 4)))
+            value = 0
+            shift = 0
+    if shift:
+        raise ValueError("move log ends part way through a move")
+    return moves
+
+class MoveLog:
+    """
+    The starting board of a game, as saved by tfe_save.dumps, and the moves
+    made since, as (direction index, loc, four) tuples.
+    """
+    def __init__(self, start, moves=None):
+        self.start = start
+        self.moves = [] if moves is None else moves
+
+    @classmethod
+    def begin(cls, board):
+        """
+        Start a log of the game on `board` from its current position. The
+        board is left as it is, so recording doesn't change the game.
+        """
+        return cls(tfe_save.dumps(board))
+
+    def record(self, board, direction):
+        """
+        Record a move that has just been made on `board`.
+        """
+        loc, four = board.last_spawn
+        self.moves.append((DIRECTIONS.index(direction), loc, four))
+
+    def pop(self):
+        """
+        Forget the last move, when it's undone.
+        """
+        if self.moves:
+            self.moves.pop()
+
+    def dumps(self):
+        """
+        Get the log as bytes.
+        """
+        return b"".join([LOG_HEADER.pack(MAGIC, VERSION, len(self.start)),
+                         self.start,
+                         b"".join(encode_move(*move) for move in self.moves)])
+
+    def write(self, path):
+        """
+        Write the log to a file.
+        """
+        with open(path, "wb") as f:
+            f.write(self.dumps())
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a log from a file.
+        """
+        with open(path, "rb") as f:
+            buf = f.read()
+        if len(buf) < LOG_HEADER.size:
+            raise ValueError("{} is too short to be a move log".format(path))
+        magic, version, size = LOG_HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError("{} isn't a move log".format(path))
+        if version != VERSION:
+            raise ValueError("{} has unsupported version {}".format(path,
+                                                                    version))
+        start = buf[LOG_HEADER.size:LOG_HEADER.size + size]
+        return cls(start, decode_moves(buf[LOG_HEADER.size + size:]))
+
+    def __len__(self):
+        return len(self.moves)
+
+class Replayer:
+    """
+    Replays a MoveLog on a board, which can be moved to any turn with seek.
+    A snapshot is kept every `checkpoint_every` turns as they're reached, to
+    seek from.
+
+    The RNG is left as it was at the start, so the board can be looked at but
+    not played on from a replayed position.
+    """
+    def __init__(self, log, compact=False, bitboard=False,
+                 checkpoint_every=DEFAULT_CHECKPOINT_EVERY):
+        self.log = log
+        self.checkpoint_every = checkpoint_every
+        self.board = tfe_save.loads(log.start, compact, bitboard, "move log")
+        self.turn = 0
+        self.checkpoints = [self.board.snapshot()]
+
+    def step(self):
+        """
+        Replay the next move.
+        """
+        direction, loc, four = self.log.moves[self.turn]
+        self.board.replay_move(DIRECTIONS[direction], loc, four)
+        self.turn += 1
+        if (self.turn % self.checkpoint_every == 0
+                and len(self.checkpoints) * self.checkpoint_every == self.turn):
+            self.checkpoints.append(self.board.snapshot(self.checkpoints[-1]))
+
+    def seek(self, turn):
+        """
+        Put the board in its position after `turn` moves, and return it.
+        """
+        if not 0 <= turn <= len(self.log):
+            raise IndexError("turn {} is out of range (0 to {})"
+                                .format(turn, len(self.log)))
+        nearest = min(turn // self.checkpoint_every, len(self.checkpoints) - 1)
+        if turn < self.turn or nearest * self.checkpoint_every > self.turn:
+            self.board.restore(self.checkpoints[nearest])
+            self.turn = nearest * self.checkpoint_every
+        while self.turn < turn:
+            self.step()
+        return self.board
+
+def get_args():
+    """
+    Parse arg
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--turn", type=int, action="append",
+            help="Turn to show (default: the last). Can be given more than "
+                 "once, and negative turns count back from the end (-1 is the "
+                 "last)")
+    parser.add_argument("--checkpoint-every", type=int,
+            default=DEFAULT_CHECKPOINT_EVERY,
+            help="Number of turns between checkpoints")
+    parser.add_argument("--compact", action="store_true",
+            help="Store the board compactly, as tile exponents")
+    parser.add_argument("--bitboard", action="store_true",
+            help="Replay on a BitBoard (4x4 only)")
+    parser.add_argument("--no-ansi", action="store_true",
+            help="Don't use ANSI colours")
+    parser.add_argument("log", help="Move log to replay")
+    args = parser.parse_args()
+    if args.checkpoint_every < 1:
+        parser.error("--checkpoint-every must be at least 1")
+    if args.compact and args.bitboard:
+        parser.error("--compact can't be used with --bitboard")
+    return args
+
+if __name__ == "__main__":
+    args = get_args()
+    log = MoveLog.read(args.log)
+    replayer = Replayer(log, args.compact, args.bitboard, args.checkpoint_every)
+    for turn in args.turn or [len(log)]:
+        if turn < 0:
+            turn += len(log) + 1
+        start = perf_counter()
+        board = replayer.seek(turn)
+        elapsed = perf_counter() - start
+        print("turn {} of {}, score {}".format(turn, len(log), board.score))
+        board.write_to(sys.stdout, ansi=not args.no_ansi)
+        print("(seek took {:.3f}s)".format(elapsed))
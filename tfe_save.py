@@ -0,0 +1,145 @@
+"""
+Saving and loading boards, in a compact binary format:
+
+- a header with a magic number, the format version, n, the score and the kind
+  of RNG,
+- the state of the RNG,
+- the board, as n ** 2 bytes of tile exponents (0 for empty squares).
+
+Files are loaded through mmap, so that the board can be copied straight out of
+the page cache rather than being parsed.
+"""
+
+import mmap
+import os
+import struct
+from random import Random
+
+from tfe_base import TFEBoard, CounterRNG
+from tfe_bitboard import BitBoard, MAX_EXP
+from tfe_parallel import ParallelTFEBoard
+
+MAGIC = b"2048"
+VERSION = 1
+
+# magic, version, n, score, RNG kind
+HEADER = struct.Struct("<4sBIQB")
+RNG_RANDOM = 0
+RNG_COUNTER = 1
+# random.Random: version, 625 words of Mersenne Twister state, and the cached
+# gaussian (if there is one)
+RANDOM_STATE = struct.Struct("<I625I?d")
+# CounterRNG: seed and counter
+COUNTER_STATE = struct.Struct("<QQ")
+
+def pack_rng(rng):
+    """
+    Get the kind and packed state of an RNG.
+    """
+    if isinstance(rng, CounterRNG):
+        return RNG_COUNTER, COUNTER_STATE.pack(*rng.getstate())
+    if isinstance(rng, Random):
+        version, words, gauss = rng.getstate()
+        return RNG_RANDOM, RANDOM_STATE.pack(version, *words, gauss is not None,
+                                             gauss or 0.0)
+    raise TypeError("can only save boards using random.Random or CounterRNG")
+
+def unpack_rng(kind, buf, offset):
+    """
+    Make an RNG from its packed state, returning it and the offset just after
+    the state.
+    """
+    if kind == RNG_COUNTER:
+        rng = CounterRNG()
+        rng.setstate(COUNTER_STATE.unpack_from(buf, offset))
+        return rng, offset + COUNTER_STATE.size
+    if kind == RNG_RANDOM:
+        version, *words, has_gauss, gauss = RANDOM_STATE.unpack_from(buf,
+                                                                     offset)
+        rng = Random()
+        rng.setstate((version, tuple(words), gauss if has_gauss else None))
+        return rng, offset + RANDOM_STATE.size
+    raise ValueError("unknown RNG kind {}".format(kind))
+
+def dumps(board):
+    """
+    Get the saved form of a board (TFEBoard or BitBoard), as bytes. The board
+    itself isn't changed.
+
+    The order of a TFEBoard's empty square index isn't saved, so a loaded game
+    gets new tiles in different squares from the one saved, although it's just
+    as random.
+    """
+    kind, rng_state = pack_rng(board.rng)
+    if board.compact:
+        grid = bytes(board.squares)
+    else:
+        grid = bytes(square.bit_length() - 1 if square else 0
+                        for square in board.squares)
+    return b"".join([HEADER.pack(MAGIC, VERSION, board.n, board.score, kind),
+                     rng_state, grid])
+
+def loads(buf, compact=False, bitboard=False, name="buffer", processes=None):
+    """
+    Make a board from its saved form in `buf` (anything supporting the buffer
+    protocol), as a TFEBoard (compact or not) or a BitBoard, or a
+    ParallelTFEBoard with that many processes if `processes` is given. `name`
+    is used in error messages.
+    """
+    if len(buf) < HEADER.size:
+        raise ValueError("{} is too short to be a saved game".format(name))
+    magic, version, n, score, kind = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("{} isn't a saved game".format(name))
+    if version != VERSION:
+        raise ValueError("{} has unsupported version {}".format(name, version))
+    rng, offset = unpack_rng(kind, buf, HEADER.size)
+    if len(buf) != offset + n ** 2:
+        raise ValueError("{} has the wrong size for a board of size {}"
+                            .format(name, n))
+    if bitboard and n != 4:
+        raise ValueError("{} has a board of size {}, not 4".format(name, n))
+    # a BitBoard square is a nibble, so bigger tiles would spill into the next
+    if bitboard and max(buf[offset:offset + n ** 2]) > MAX_EXP:
+        raise ValueError("{} has a tile too big for a bitboard".format(name))
+    rng_state = rng.getstate()
+    # making a board adds random tiles, which are then overwritten
+    if bitboard:
+        board = BitBoard(rng=rng)
+    elif processes is not None:
+        board = ParallelTFEBoard(n, processes, rng=rng)
+    else:
+        board = TFEBoard(n, rng=rng, compact=compact)
+    # through a memoryview, so the squares are copied once, straight out of
+    # buf. It's released before returning, so that an mmap can be closed.
+    with memoryview(buf) as view, view[offset:] as grid:
+        if board.compact:
+            board.squares = bytearray(grid)
+        else:
+            board.squares = [1 << exp if exp else 0 for exp in grid]
+    board.score = score
+    rng.setstate(rng_state)
+    board.reindex()
+    return board
+
+def save(board, path):
+    """
+    Save a board to a file. The file is written in full and then moved into
+    place, so an interrupted save doesn't lose the last one.
+    """
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "wb") as f:
+        f.write(dumps(board))
+    os.replace(tmp_path, path)
+
+def load(path, compact=False, bitboard=False, processes=None):
+    """
+    Load a board from a file, as in loads.
+    """
+    with open(path, "rb") as f:
+        # mmap can't map an empty file, so short ones are caught here
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError("{} is too short to be a saved game".format(path))
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with buf:
+        return loads(buf, compact, bitboard, path, processes)
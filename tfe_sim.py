@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Headless 2048 simulator: play lots of games automatically across several
+processes, and summarise how they went.
+"""
+
+import argparse
+import os
+import statistics
+from collections import Counter
+from multiprocessing import Pool
+from time import perf_counter
+
+from tfe_base import TFEBoard, CounterRNG
+from tfe_ai import STRATEGIES, DEFAULT_DEPTH, make_player
+from tfe_replay import MoveLog
+
+def get_args():
+    """
+    Parse arg
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--games", type=int, default=100,
+            help="Number of games to play")
+    parser.add_argument("--strategy", choices=STRATEGIES, default="simple",
+            help="Strategy to play with")
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH,
+            help="Search depth for the expectimax strategy")
+    parser.add_argument("--processes", type=int, default=None,
+            help="Number of worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="Base seed. Game i is played with seed + i")
+    parser.add_argument("--counter-rng", action="store_true",
+            help="Use the counter-based random number generator")
+    parser.add_argument("--compact", action="store_true",
+            help="Store boards compactly, as tile exponents")
+    parser.add_argument("--record", metavar="DIR",
+            help="Record a move log of each game in this directory, as "
+                 "game-SEED.log")
+    parser.add_argument("n", type=int, nargs="?", default=4,
+            help="Board size")
+    args = parser.parse_args()
+    if args.compact and args.strategy == "expectimax":
+        parser.error("the expectimax strategy can't be used with --compact")
+    return args
+
+def play_game(job):
+    """
+    Play one game from a (seed, n, strategy, depth, counter_rng, compact,
+    record) tuple, returning the score, the biggest tile, the number of moves
+    and the time taken. If `record` is a directory, the game's move log is
+    written there.
+    """
+    seed, n, strategy, depth, counter_rng, compact, record = job
+    start = perf_counter()
+    rng = CounterRNG(seed) if counter_rng else None
+    board = TFEBoard(n, seed=seed, rng=rng, compact=compact)
+    log = MoveLog.begin(board) if record is not None else None
+    player = make_player(strategy, board, depth)
+    moves = 0
+    while True:
+        move = player.best_move()
+        if move is None:
+            break
+        getattr(board, move)()
+        if log is not None:
+            log.record(board, move)
+        moves += 1
+    if log is not None:
+        log.write(os.path.join(record, "game-{}.log".format(seed)))
+    return board.score, max(board.tile_values()), moves, perf_counter() - start
+
+def simulate(games, n, strategy, depth, processes, seed, counter_rng=False,
+             compact=False, record=None):
+    """
+    Play the games in a process pool, returning the list of results and the
+    wall-clock time taken.
+    """
+    jobs = [(seed + i, n, strategy, depth, counter_rng, compact, record)
+                for i in range(games)]
+    if record is not None:
+        os.makedirs(record, exist_ok=True)
+    start = perf_counter()
+    with Pool(processes) as pool:
+        results = list(pool.imap_unordered(play_game, jobs))
+    return results, perf_counter() - start
+
+def summarise(results, wall_time):
+    """
+    Format a summary of game results.
+    """
+    scores = sorted(score for score, _, _, _ in results)
+    total_moves = sum(moves for _, _, moves, _ in results)
+    total_time = sum(elapsed for _, _, _, elapsed in results)
+    lines = ["games: {}".format(len(results)),
+             "score: min {} / median {} / mean {:.1f} / max {}".format(
+                scores[0], statistics.median(scores),
+                statistics.mean(scores), scores[-1])]
+    if len(scores) > 1:
+        deciles = statistics.quantiles(scores, n=10, method="inclusive")
+        lines.append("score deciles: {}".format(
+                        " ".join("{:.0f}".format(d) for d in deciles)))
+    lines.append("max tiles:")
+    tiles = Counter(tile for _, tile, _, _ in results)
+    for tile in sorted(tiles):
+        lines.append("  {:>7}: {:>5} ({:.1%})".format(
+                        tile, tiles[tile], tiles[tile] / len(results)))
+    lines.append("moves: {} ({:.1f} per game)".format(
+                    total_moves, total_moves / len(results)))
+    lines.append("moves/s: {:.0f} per process, {:.0f} overall".format(
+                    total_moves / total_time, total_moves / wall_time))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    args = get_args()
+    results, wall_time = simulate(args.games, args.n, args.strategy,
+                                  args.depth, args.processes, args.seed,
+                                  args.counter_rng, args.compact,
+                                  args.record)
+    print(summarise(results, wall_time))
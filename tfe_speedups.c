@@ -0,0 +1,385 @@
+/*
+ * Optional compiled versions of the hot parts of a compact TFEBoard: sifting
+ * lines of tile exponents held in a bytearray, and adding a random tile. The
+ * board's EmptyIndex lists are updated in exactly the same order as the pure
+ * Python code does, so boards behave identically either way (tfe_check.py
+ * checks this). For ParallelTFEBoard, lines can also be sifted without an
+ * index at all.
+ *
+ * Build it in place with:
+ *
+ *     cc -O2 -shared -fPIC $(python3-config --includes) tfe_speedups.c \
+ *         -o tfe_speedups$(python3-config --extension-suffix)
+ *
+ * and tfe_base will pick it up when imported.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+/* biggest exponent a byte can hold, and so the biggest merge result + 1 */
+#define MAX_EXP 255
+
+static int
+set_int(PyObject *list, Py_ssize_t i, Py_ssize_t value)
+{
+    PyObject *v = PyLong_FromSsize_t(value);
+    if (v == NULL)
+        return -1;
+    /* steals the reference to v */
+    return PyList_SetItem(list, i, v);
+}
+
+static Py_ssize_t
+get_int(PyObject *list, Py_ssize_t i)
+{
+    return PyLong_AsSsize_t(PyList_GET_ITEM(list, i));
+}
+
+/*
+ * The lists of the EmptyIndex sift_line keeps up to date, or NULLs if there
+ * isn't one.
+ */
+typedef struct {
+    PyObject *cells;
+    PyObject *pos;
+} index_t;
+
+/* EmptyIndex.add */
+static int
+empty_add(PyObject *cells, PyObject *pos, Py_ssize_t ind)
+{
+    PyObject *v;
+    int ret;
+    if (set_int(pos, ind, PyList_GET_SIZE(cells)) < 0)
+        return -1;
+    v = PyLong_FromSsize_t(ind);
+    if (v == NULL)
+        return -1;
+    ret = PyList_Append(cells, v);
+    Py_DECREF(v);
+    return ret;
+}
+
+/* EmptyIndex.replace */
+static int
+empty_replace(PyObject *cells, PyObject *pos, Py_ssize_t old, Py_ssize_t new)
+{
+    Py_ssize_t p = get_int(pos, old);
+    if (p == -1 && PyErr_Occurred())
+        return -1;
+    if (set_int(cells, p, new) < 0 || set_int(pos, new, p) < 0
+            || set_int(pos, old, -1) < 0)
+        return -1;
+    return 0;
+}
+
+/* EmptyIndex.remove */
+static int
+empty_remove(PyObject *cells, PyObject *pos, Py_ssize_t ind)
+{
+    Py_ssize_t p, last, size = PyList_GET_SIZE(cells);
+    p = get_int(pos, ind);
+    if (p == -1 && PyErr_Occurred())
+        return -1;
+    last = get_int(cells, size - 1);
+    if (last == -1 && PyErr_Occurred())
+        return -1;
+    if (PyList_SetSlice(cells, size - 1, size, NULL) < 0)
+        return -1;
+    if (last != ind) {
+        if (set_int(cells, p, last) < 0 || set_int(pos, last, p) < 0)
+            return -1;
+    }
+    return set_int(pos, ind, -1);
+}
+
+static int
+index_add(index_t *index, Py_ssize_t ind)
+{
+    if (index->cells == NULL)
+        return 0;
+    return empty_add(index->cells, index->pos, ind);
+}
+
+static int
+index_replace(index_t *index, Py_ssize_t old, Py_ssize_t new)
+{
+    if (index->cells == NULL)
+        return 0;
+    return empty_replace(index->cells, index->pos, old, new);
+}
+
+/*
+ * sift_line from tfe_base, with exponents, on the line of `len` squares from
+ * `start` in steps of `step`. Merges are counted in merges[exponent made], so
+ * the score can be worked out as a Python int at the end.
+ */
+static int
+sift_line(unsigned char *squares, Py_ssize_t start, Py_ssize_t step,
+          Py_ssize_t len, index_t *index, int *any_moved,
+          Py_ssize_t *merges, Py_ssize_t *moved)
+{
+    Py_ssize_t ind, i, write = 0;
+    /* exponent of the tile at write - 1, if it hasn't merged yet */
+    unsigned last = 0;
+    for (ind = 0; ind < len; ind++) {
+        unsigned square;
+        i = start + ind * step;
+        square = squares[i];
+        if (square == 0)
+            continue;
+        if (square == last) {
+            if (square == MAX_EXP) {
+                PyErr_SetString(PyExc_ValueError,
+                                "byte must be in range(0, 256)");
+                return -1;
+            }
+            *any_moved = 1;
+            squares[start + (write - 1) * step] = square + 1;
+            merges[square + 1]++;
+            squares[i] = 0;
+            if (index_add(index, i) < 0)
+                return -1;
+            (*moved)++;
+            last = 0;
+        }
+        else {
+            if (write != ind) {
+                Py_ssize_t w = start + write * step;
+                *any_moved = 1;
+                squares[w] = square;
+                squares[i] = 0;
+                if (index_replace(index, w, i) < 0)
+                    return -1;
+                (*moved)++;
+            }
+            last = square;
+            write++;
+        }
+    }
+    return 0;
+}
+
+static int
+range_attr(PyObject *seq, const char *name, Py_ssize_t *out)
+{
+    PyObject *v = PyObject_GetAttrString(seq, name);
+    if (v == NULL)
+        return -1;
+    *out = PyLong_AsSsize_t(v);
+    Py_DECREF(v);
+    return (*out == -1 && PyErr_Occurred()) ? -1 : 0;
+}
+
+/* score gained from the merge counts, as sum(count << exp) */
+static PyObject *
+merge_gain(Py_ssize_t *merges)
+{
+    int exp;
+    PyObject *gain = PyLong_FromLong(0);
+    for (exp = 1; exp <= MAX_EXP && gain != NULL; exp++) {
+        PyObject *count, *shift, *term, *total;
+        if (!merges[exp])
+            continue;
+        count = PyLong_FromSsize_t(merges[exp]);
+        shift = PyLong_FromLong(exp);
+        term = (count && shift) ? PyNumber_Lshift(count, shift) : NULL;
+        total = term ? PyNumber_Add(gain, term) : NULL;
+        Py_XDECREF(count);
+        Py_XDECREF(shift);
+        Py_XDECREF(term);
+        Py_DECREF(gain);
+        gain = total;
+    }
+    return gain;
+}
+
+/*
+ * Sift the squares in view down each of the ranges in seqs, sending index
+ * updates to `index`, and appending the index in seqs of each line that moved
+ * to `lines` unless it's None. Returns whether anything moved, the score
+ * gained and the number of tiles moved, as a tuple.
+ */
+static PyObject *
+sift_seqs(Py_buffer *view, PyObject *seqs, index_t *index, PyObject *lines)
+{
+    PyObject *fast, *gain, *result = NULL;
+    Py_ssize_t merges[MAX_EXP + 1] = {0};
+    Py_ssize_t k, moved = 0;
+    int any_moved = 0;
+    fast = PySequence_Fast(seqs, "seqs must be a sequence of ranges");
+    if (fast == NULL)
+        return NULL;
+    for (k = 0; k < PySequence_Fast_GET_SIZE(fast); k++) {
+        PyObject *seq = PySequence_Fast_GET_ITEM(fast, k);
+        Py_ssize_t start, step, len;
+        int line_moved = 0;
+        if (!PyObject_TypeCheck(seq, &PyRange_Type)) {
+            PyErr_SetString(PyExc_TypeError, "seqs must be ranges");
+            goto fail;
+        }
+        len = PyObject_Size(seq);
+        if (len < 0 || range_attr(seq, "start", &start) < 0
+                || range_attr(seq, "step", &step) < 0)
+            goto fail;
+        if (len && (start < 0 || start >= view->len
+                    || start + (len - 1) * step < 0
+                    || start + (len - 1) * step >= view->len)) {
+            PyErr_SetString(PyExc_IndexError, "seq out of range");
+            goto fail;
+        }
+        if (sift_line((unsigned char *)view->buf, start, step, len, index,
+                      &line_moved, merges, &moved) < 0)
+            goto fail;
+        if (line_moved) {
+            any_moved = 1;
+            if (lines != Py_None) {
+                PyObject *v = PyLong_FromSsize_t(k);
+                int ret = v == NULL ? -1 : PyList_Append(lines, v);
+                Py_XDECREF(v);
+                if (ret < 0)
+                    goto fail;
+            }
+        }
+    }
+    gain = merge_gain(merges);
+    if (gain != NULL)
+        result = Py_BuildValue("ONn", any_moved ? Py_True : Py_False, gain,
+                               moved);
+fail:
+    Py_DECREF(fast);
+    return result;
+}
+
+PyDoc_STRVAR(sift_all_doc,
+"sift_all(squares, seqs, cells, pos, lines=None)\n\
+\n\
+Sift a bytearray of tile exponents down each of the ranges in seqs, keeping\n\
+the EmptyIndex lists cells and pos up to date. Returns whether anything\n\
+moved, the score gained and the number of tiles moved. If lines is a list,\n\
+the index in seqs of each line that moved is appended to it.");
+
+static PyObject *
+sift_all(PyObject *self, PyObject *args)
+{
+    PyObject *squares_obj, *seqs, *cells, *pos, *lines = Py_None;
+    PyObject *result = NULL;
+    Py_buffer view;
+    index_t index = {NULL, NULL};
+    if (!PyArg_ParseTuple(args, "OOO!O!|O", &squares_obj, &seqs,
+                          &PyList_Type, &cells, &PyList_Type, &pos, &lines))
+        return NULL;
+    if (lines != Py_None && !PyList_Check(lines)) {
+        PyErr_SetString(PyExc_TypeError, "lines must be a list or None");
+        return NULL;
+    }
+    if (PyObject_GetBuffer(squares_obj, &view, PyBUF_WRITABLE) < 0)
+        return NULL;
+    if (PyList_GET_SIZE(pos) != view.len)
+        PyErr_SetString(PyExc_ValueError, "pos is the wrong size");
+    else {
+        index.cells = cells;
+        index.pos = pos;
+        result = sift_seqs(&view, seqs, &index, lines);
+    }
+    PyBuffer_Release(&view);
+    return result;
+}
+
+PyDoc_STRVAR(sift_count_doc,
+"sift_count(squares, seqs, lines=None)\n\
+\n\
+Sift as in sift_all, but without an empty square index to keep up to date.\n\
+Returns whether anything moved, the score gained and the number of tiles\n\
+moved, and appends the index of each line that moved to lines as sift_all\n\
+does.");
+
+static PyObject *
+sift_count(PyObject *self, PyObject *args)
+{
+    PyObject *squares_obj, *seqs, *lines = Py_None, *result;
+    Py_buffer view;
+    index_t index = {NULL, NULL};
+    if (!PyArg_ParseTuple(args, "OO|O", &squares_obj, &seqs, &lines))
+        return NULL;
+    if (lines != Py_None && !PyList_Check(lines)) {
+        PyErr_SetString(PyExc_TypeError, "lines must be a list or None");
+        return NULL;
+    }
+    if (PyObject_GetBuffer(squares_obj, &view, PyBUF_WRITABLE) < 0)
+        return NULL;
+    result = sift_seqs(&view, seqs, &index, lines);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+PyDoc_STRVAR(add_random_doc,
+"add_random(squares, cells, pos, rng)\n\
+\n\
+Put a new tile in a random empty square of a bytearray of tile exponents,\n\
+drawing from rng as TFEBoard.add_random does and keeping the EmptyIndex\n\
+lists cells and pos up to date. Returns (loc, four). cells mustn't be empty.");
+
+static PyObject *
+add_random(PyObject *self, PyObject *args)
+{
+    PyObject *squares_obj, *cells, *pos, *rng, *loc_obj, *r;
+    Py_buffer view;
+    Py_ssize_t loc;
+    double x;
+    int four;
+    if (!PyArg_ParseTuple(args, "OO!O!O", &squares_obj, &PyList_Type, &cells,
+                          &PyList_Type, &pos, &rng))
+        return NULL;
+    loc_obj = PyObject_CallMethod(rng, "choice", "O", cells);
+    if (loc_obj == NULL)
+        return NULL;
+    loc = PyLong_AsSsize_t(loc_obj);
+    Py_DECREF(loc_obj);
+    if (loc == -1 && PyErr_Occurred())
+        return NULL;
+    r = PyObject_CallMethod(rng, "random", NULL);
+    if (r == NULL)
+        return NULL;
+    x = PyFloat_AsDouble(r);
+    Py_DECREF(r);
+    if (x == -1.0 && PyErr_Occurred())
+        return NULL;
+    four = x >= 0.9;
+    if (PyObject_GetBuffer(squares_obj, &view, PyBUF_WRITABLE) < 0)
+        return NULL;
+    if (loc < 0 || loc >= view.len) {
+        PyErr_SetString(PyExc_IndexError, "loc out of range");
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    if (empty_remove(cells, pos, loc) < 0) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    ((unsigned char *)view.buf)[loc] = four ? 2 : 1;
+    PyBuffer_Release(&view);
+    return Py_BuildValue("nO", loc, four ? Py_True : Py_False);
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"sift_all", sift_all, METH_VARARGS, sift_all_doc},
+    {"sift_count", sift_count, METH_VARARGS, sift_count_doc},
+    {"add_random", add_random, METH_VARARGS, add_random_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    "tfe_speedups",
+    "Compiled sifting and tile adding for compact TFEBoards.",
+    -1,
+    speedups_methods
+};
+
+PyMODINIT_FUNC
+PyInit_tfe_speedups(void)
+{
+    return PyModule_Create(&speedups_module);
+}